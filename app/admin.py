@@ -1,10 +1,10 @@
-from aiogram import Router, F
+from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Filter, Command
 from aiogram.fsm.context import FSMContext
 
 from app.states import Newsletter
-from app.database.requests import get_users
+from app.broadcast import start_broadcast
 
 admin = Router()
 
@@ -18,11 +18,7 @@ async def newsletter(message: Message, state: FSMContext):
     await message.answer('Enter your message to news letter it')
     
 @admin.message(Newsletter.message)
-async def newsletter_message(message: Message, state: FSMContext):
+async def newsletter_message(message: Message, state: FSMContext, bot: Bot):
     await state.clear()
-    users = await get_users()
-    for user in users:
-        try:
-            await message.send_copy(chat_id=user.tg_id)
-        except Exception as e:
-            print(e)
\ No newline at end of file
+    await start_broadcast(bot, message.chat.id, message.message_id, message.chat.id)
+    await message.answer('Newsletter started, progress will be reported here')
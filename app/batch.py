@@ -0,0 +1,267 @@
+"""
+Bulk generation from a JSONL file, through the same client, limiter, key pool and cache as the bot.
+
+    python -m app.batch prompts.jsonl --out batch_output --concurrency 8
+
+Each input line is one item:
+
+    {"id": "cabin", "kind": "image", "prompt": "A wooden cabin in the snow"}
+    {"kind": "speech", "text": "Hello there!", "voice": "Kore"}
+    {"kind": "text", "prompt": "Write a haiku about autumn"}
+    {"kind": "vision", "image": "photos/cat.jpg", "question": "What breed is this cat?"}
+
+Every finished item gets its own file in the output directory (<id>.jpg, <id>.wav, <id>.txt) and a line
+in results.jsonl. Running the same command again skips the items that already succeeded.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+
+import config
+from app.client import start_client, close_client
+from app.generators import generate_text, handle_generate_image, handle_generate_speech, analyze_image_data, VOICES
+from app.imaging import image_filename, close_pool
+
+# --- Batch settings (override any of them in config.py) ---
+BATCH_CONCURRENCY = getattr(config, "BATCH_CONCURRENCY", 8)
+# Seconds between progress lines
+BATCH_REPORT_INTERVAL = getattr(config, "BATCH_REPORT_INTERVAL", 10.0)
+BATCH_DEFAULT_VOICE = getattr(config, "BATCH_DEFAULT_VOICE", "Puck")
+
+RESULTS_FILE = "results.jsonl"
+KINDS = ("image", "speech", "text", "vision")
+
+log = logging.getLogger(__name__)
+
+
+class BatchItemError(Exception):
+    """
+    Raised when an item is invalid or its generation failed.
+    """
+
+
+class BatchStats:
+    """
+    Counts finished items and bytes written, and formats throughput reports.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ok = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started
+        done = self.ok + self.failed
+        rate = done / elapsed if elapsed else 0.0
+        return (f"{done} done ({self.ok} ok, {self.failed} failed, {self.skipped} skipped) in {elapsed:.1f}s: "
+                f"{rate:.2f} items/s, {self.bytes / 2**20:.1f} MB written")
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {"ok": self.ok, "failed": self.failed, "skipped": self.skipped, "bytes": self.bytes,
+                "seconds": round(elapsed, 3), "items_per_second": round((self.ok + self.failed) / elapsed, 3) if elapsed else 0.0}
+
+
+def read_items(path):
+    """
+    Yields the items of a JSONL file. Items without an id are numbered by line, and
+    vision image paths are resolved against the file's directory.
+    """
+    path = Path(path)
+    with path.open(encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                log.error(f"{path}:{number}: invalid JSON, skipped: {e}")
+                continue
+            item.setdefault("id", f"{number:06d}")
+            if item.get("kind") == "vision" and item.get("image"):
+                item["image"] = str(path.parent / item["image"])
+            yield item
+
+def load_finished(out_dir) -> set:
+    """
+    Returns the ids that already succeeded in a previous run and whose output file still exists.
+    """
+    results = Path(out_dir) / RESULTS_FILE
+    finished = set()
+    if not results.exists():
+        return finished
+    with results.open(encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted run may be cut off
+                continue
+            if record.get("status") == "ok" and record.get("file") and (Path(out_dir) / record["file"]).exists():
+                finished.add(record["id"])
+            else:
+                finished.discard(record.get("id"))
+    return finished
+
+
+async def generate_item(item: dict, use_cache: bool = True):
+    """
+    Generates one item. Returns (file suffix or full file name, data) or raises BatchItemError.
+    """
+    kind = item.get("kind")
+    stem = _safe_name(item["id"])
+    if kind == "image":
+        result = await handle_generate_image(_required(item, "prompt"), None, use_cache=use_cache)
+        if isinstance(result, str):
+            raise BatchItemError(result)
+        return image_filename(result.data, stem), result.data
+    if kind == "speech":
+        voice = item.get("voice", BATCH_DEFAULT_VOICE)
+        if voice not in VOICES:
+            raise BatchItemError(f"Unknown voice: {voice}")
+        result = await handle_generate_speech(_required(item, "text"), voice, None, use_cache=use_cache)
+        if result is None:
+            raise BatchItemError("Speech synthesis failed.")
+        return f"{stem}.wav", result.data
+    if kind == "text":
+        try:
+            text = await generate_text(_required(item, "prompt"), use_cache=use_cache)
+        except BatchItemError:
+            raise
+        except Exception as e:
+            raise BatchItemError(f"Text generation failed: {e}")
+        return f"{stem}.txt", text.encode()
+    if kind == "vision":
+        try:
+            image_data = await asyncio.to_thread(Path(_required(item, "image")).read_bytes)
+        except OSError as e:
+            raise BatchItemError(f"Could not read the image: {e}")
+        answer = await analyze_image_data(image_data, item.get("question"), use_cache=use_cache)
+        if answer is None:
+            raise BatchItemError("Image analysis failed.")
+        return f"{stem}.txt", answer.encode()
+    raise BatchItemError(f"Unknown kind {kind!r}, expected one of: {', '.join(KINDS)}.")
+
+def _required(item: dict, field: str):
+    value = item.get(field)
+    if not value:
+        raise BatchItemError(f"Missing {field!r}.")
+    return value
+
+def _safe_name(item_id) -> str:
+    return re.sub(r"[^\w.-]", "_", str(item_id))[:100] or "item"
+
+def _write_atomic(path: Path, data):
+    # Written under a temporary name first, so an interrupted run never leaves a truncated file behind
+    temporary = path.with_name(f".{path.name}.part")
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+async def run_batch(items, out_dir, concurrency=BATCH_CONCURRENCY, use_cache=True, resume=True) -> dict:
+    """
+    Generates `items` (dicts, e.g. from read_items()) with at most `concurrency` in flight, writing
+    each result to `out_dir` as soon as it is ready. Returns the throughput summary.
+    The Gemini client must be started (see start_client); the caller also owns its shutdown.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    finished = load_finished(out_dir) if resume else set()
+    stats = BatchStats()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    with open(out_dir / RESULTS_FILE, "a" if resume else "w", encoding="utf-8") as results:
+
+        def record(item, **fields):
+            results.write(json.dumps({"id": item["id"], "kind": item.get("kind"), **fields}, ensure_ascii=False) + "\n")
+            results.flush()
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                started = time.monotonic()
+                try:
+                    name, data = await generate_item(item, use_cache)
+                    await asyncio.to_thread(_write_atomic, out_dir / name, data)
+                except BatchItemError as e:
+                    stats.failed += 1
+                    log.warning(f"Item {item['id']} failed: {e}")
+                    record(item, status="error", error=str(e), seconds=round(time.monotonic() - started, 3))
+                except Exception as e:
+                    stats.failed += 1
+                    log.error(f"Item {item['id']} failed unexpectedly: {e}")
+                    record(item, status="error", error=repr(e), seconds=round(time.monotonic() - started, 3))
+                else:
+                    stats.ok += 1
+                    stats.bytes += len(data)
+                    record(item, status="ok", file=name, bytes=len(data), seconds=round(time.monotonic() - started, 3))
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(BATCH_REPORT_INTERVAL)
+                log.info(stats.report())
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        progress = asyncio.create_task(reporter())
+        try:
+            seen = set()
+            for item in items:
+                if item["id"] in seen:
+                    log.warning(f"Duplicate id {item['id']}, skipped.")
+                    continue
+                seen.add(item["id"])
+                if item["id"] in finished:
+                    stats.skipped += 1
+                    continue
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            progress.cancel()
+            for task in workers:
+                task.cancel()
+
+    log.info(stats.report())
+    return stats.as_dict()
+
+
+async def _main(args):
+    await start_client()
+    try:
+        return await run_batch(read_items(args.input), args.out, args.concurrency,
+                               use_cache=not args.no_cache, resume=not args.restart)
+    finally:
+        await close_client()
+        await close_pool()
+
+def main():
+    from app.logs import setup_logging
+
+    parser = argparse.ArgumentParser(description="Generate images, speech and text in bulk from a JSONL file.")
+    parser.add_argument("input", help="JSONL file with one item per line.")
+    parser.add_argument("--out", default="batch_output", help="Directory for the generated files and results.jsonl.")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Items generated at the same time.")
+    parser.add_argument("--no-cache", action="store_true", help="Always ask the API instead of the response cache.")
+    parser.add_argument("--restart", action="store_true", help="Ignore earlier results and generate everything again.")
+    args = parser.parse_args()
+
+    setup_logging(log_file=None)
+    summary = asyncio.run(_main(args))
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import config
+from app.limiter import TokenBucket
+from app.database.requests import (get_users, count_active_users, deactivate_users,
+                                   create_broadcast, get_running_broadcasts, save_broadcast_progress, claim_broadcast)
+
+# --- Broadcast settings (override any of them in config.py) ---
+# Telegram allows about 30 messages per second across all chats
+BROADCAST_RATE = getattr(config, "BROADCAST_RATE", 25)
+BROADCAST_CONCURRENCY = getattr(config, "BROADCAST_CONCURRENCY", 20)
+BROADCAST_BATCH_SIZE = getattr(config, "BROADCAST_BATCH_SIZE", 500)
+# How often progress is saved to the database and reported to the admin (seconds)
+BROADCAST_SAVE_INTERVAL = getattr(config, "BROADCAST_SAVE_INTERVAL", 5)
+BROADCAST_REPORT_INTERVAL = getattr(config, "BROADCAST_REPORT_INTERVAL", 15)
+# A broadcast whose sender saved no progress for this long is taken over by another process (seconds)
+BROADCAST_LEASE = getattr(config, "BROADCAST_LEASE", 60)
+
+log = logging.getLogger(__name__)
+
+# Keep references to running broadcasts so they aren't garbage collected
+_running = {}
+
+
+class Broadcaster:
+    """
+    Copies one message to every active user.
+    Sends concurrently under a global token bucket, waits out RetryAfter for all workers at once,
+    marks users who blocked the bot as inactive and saves a resumable watermark to the database.
+    Each user gets a single message, so the per-chat limit can't be hit.
+    """
+
+    def __init__(self, bot: Bot, broadcast_id, from_chat_id, message_id, admin_chat_id,
+                 last_user_id=0, sent=0, failed=0, blocked=0):
+        self.bot = bot
+        self.broadcast_id = broadcast_id
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.admin_chat_id = admin_chat_id
+        self.last_user_id = last_user_id
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.total = 0
+        self.started = time.monotonic()
+        self.done_this_run = 0
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.paused_until = 0.0
+        self.queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+        # User ids in send order; the watermark only advances past ids that are finished
+        self.pending = deque()
+        self.finished = set()
+        self.dead = []
+
+    async def run(self):
+        self.total = self.sent + self.failed + self.blocked + await count_active_users(self.last_user_id)
+        status_message = await self.bot.send_message(self.admin_chat_id, self._status_text())
+        workers = [asyncio.create_task(self._worker()) for _ in range(BROADCAST_CONCURRENCY)]
+        reporter = asyncio.create_task(self._report(status_message))
+        try:
+            await self._produce()
+            await self.queue.join()
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            await self._save()
+
+        await save_broadcast_progress(self.broadcast_id, status='done')
+        await self._edit(status_message, "Newsletter finished.\n" + self._status_text())
+        log.info(f"Broadcast {self.broadcast_id} finished: sent={self.sent}, failed={self.failed}, blocked={self.blocked}.")
+
+    async def _produce(self):
+        async for user in get_users(self.last_user_id, BROADCAST_BATCH_SIZE, active_only=True):
+            self.pending.append(user.id)
+            await self.queue.put((user.id, user.tg_id))
+
+    async def _worker(self):
+        while True:
+            user_id, tg_id = await self.queue.get()
+            try:
+                await self._send(user_id, tg_id)
+            finally:
+                self.finished.add(user_id)
+                self.done_this_run += 1
+                self.queue.task_done()
+
+    async def _send(self, user_id, tg_id):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+            try:
+                await self.bot.copy_message(chat_id=tg_id, from_chat_id=self.from_chat_id, message_id=self.message_id)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                log.warning(f"Broadcast {self.broadcast_id}: flood control, pausing for {e.retry_after}s.")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            except TelegramForbiddenError:
+                self.blocked += 1
+                self.dead.append(user_id)
+                return
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self.blocked += 1
+                    self.dead.append(user_id)
+                else:
+                    self.failed += 1
+                    log.error(f"Broadcast {self.broadcast_id}: could not send to {tg_id}: {e}")
+                return
+            except Exception as e:
+                self.failed += 1
+                log.error(f"Broadcast {self.broadcast_id}: could not send to {tg_id}: {e}")
+                return
+
+    async def _save(self):
+        while self.pending and self.pending[0] in self.finished:
+            self.finished.discard(self.pending[0])
+            self.last_user_id = self.pending.popleft()
+        if self.dead:
+            dead, self.dead = self.dead, []
+            await deactivate_users(dead)
+        await save_broadcast_progress(self.broadcast_id, last_user_id=self.last_user_id, lease_until=_lease(),
+                                      sent=self.sent, failed=self.failed, blocked=self.blocked)
+
+    async def _report(self, status_message):
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(BROADCAST_SAVE_INTERVAL)
+            try:
+                await self._save()
+            except Exception as e:
+                log.error(f"Broadcast {self.broadcast_id}: could not save progress: {e}")
+            if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                last_report = time.monotonic()
+                await self._edit(status_message, self._status_text())
+
+    def _status_text(self):
+        processed = self.sent + self.failed + self.blocked
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = self.done_this_run / elapsed
+        remaining = max(self.total - processed, 0)
+        eta = f"{remaining / rate:.0f}s" if rate > 0 else "unknown"
+        return (
+            f"Newsletter #{self.broadcast_id}: {processed}/{self.total}\n"
+            f"Sent: {self.sent}, blocked: {self.blocked}, failed: {self.failed}\n"
+            f"Speed: {rate:.1f} msg/s, ETA: {eta}"
+        )
+
+    async def _edit(self, status_message, text):
+        try:
+            await status_message.edit_text(text)
+        except Exception as e:
+            log.warning(f"Broadcast {self.broadcast_id}: could not update the status message: {e}")
+
+
+def _lease():
+    return datetime.now() + timedelta(seconds=BROADCAST_LEASE)
+
+def _start(broadcaster: Broadcaster):
+    task = asyncio.create_task(broadcaster.run())
+    _running[broadcaster.broadcast_id] = task
+    task.add_done_callback(lambda t: _running.pop(broadcaster.broadcast_id, None))
+    return task
+
+async def start_broadcast(bot: Bot, from_chat_id, message_id, admin_chat_id):
+    """
+    Records a new broadcast and starts sending it in the background.
+    """
+    broadcast_id = await create_broadcast(from_chat_id, message_id, admin_chat_id, lease_until=_lease())
+    return _start(Broadcaster(bot, broadcast_id, from_chat_id, message_id, admin_chat_id))
+
+async def _resume(bot: Bot, broadcast, delay=0.0):
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if not await claim_broadcast(broadcast.id, _lease()):
+        log.info(f"Broadcast {broadcast.id} is being sent by another process.")
+        return
+    # Progress may have moved on since the broadcast was listed
+    for current in await get_running_broadcasts():
+        if current.id == broadcast.id:
+            broadcast = current
+    log.info(f"Resuming broadcast {broadcast.id} after user {broadcast.last_user_id}.")
+    _start(Broadcaster(bot, broadcast.id, broadcast.from_chat_id, broadcast.message_id, broadcast.admin_chat_id,
+                       broadcast.last_user_id, broadcast.sent, broadcast.failed, broadcast.blocked))
+
+async def resume_broadcasts(bot: Bot):
+    """
+    Restarts every broadcast that was still running when the bot stopped.
+    One still leased by another process is retried once its lease lapses, in case that process is gone.
+    """
+    now = datetime.now()
+    for broadcast in await get_running_broadcasts():
+        delay = (broadcast.lease_until - now).total_seconds() + 1 if broadcast.lease_until else 0.0
+        task = asyncio.create_task(_resume(bot, broadcast, delay))
+        _resuming.add(task)
+        task.add_done_callback(_resuming.discard)
+
+# Resumes waiting for a lease to lapse
+_resuming = set()
@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+
+import config
+
+# --- Cache settings (override any of them in config.py) ---
+CACHE_DIR = getattr(config, "CACHE_DIR", "cache")
+CACHE_MAX_ENTRIES = getattr(config, "CACHE_MAX_ENTRIES", 1000)
+CACHE_MAX_MEMORY_BYTES = getattr(config, "CACHE_MAX_MEMORY_BYTES", 32 * 1024 * 1024)
+CACHE_MAX_DISK_BYTES = getattr(config, "CACHE_MAX_DISK_BYTES", 512 * 1024 * 1024)
+# Binary results at least this big go to disk instead of memory
+CACHE_DISK_THRESHOLD = getattr(config, "CACHE_DISK_THRESHOLD", 64 * 1024)
+# Seconds each endpoint's results stay valid; 0 disables caching for that endpoint
+CACHE_TTLS = {
+    "text": 60 * 60,
+    "vision": 24 * 60 * 60,
+    "imagen": 7 * 24 * 60 * 60,
+    "tts": 7 * 24 * 60 * 60,
+    **getattr(config, "CACHE_TTLS", {}),
+}
+
+log = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Collapses whitespace and case so trivially different prompts share a cache entry.
+    """
+    return " ".join(prompt.split()).casefold()
+
+
+def make_key(endpoint: str, model: str, prompt: str, **params) -> str:
+    """
+    Builds a stable hash of (endpoint, model, normalized prompt, extra params such as the voice).
+    """
+    raw = json.dumps([endpoint, model, normalize_prompt(prompt), params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier cache for generation results.
+    Text and small payloads live in a bounded in-memory LRU; large binary payloads (PNG/WAV) live on disk.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_entries=CACHE_MAX_ENTRIES, max_memory_bytes=CACHE_MAX_MEMORY_BYTES,
+                 max_disk_bytes=CACHE_MAX_DISK_BYTES, disk_threshold=CACHE_DISK_THRESHOLD, ttls=CACHE_TTLS):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_threshold = disk_threshold
+        self.ttls = dict(ttls)
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.counters = defaultdict(lambda: {"hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0})
+
+    def enabled(self, endpoint: str) -> bool:
+        return self.ttls.get(endpoint, 0) > 0
+
+    async def get(self, endpoint: str, key: str):
+        """
+        Returns the cached value or None.
+        """
+        if not self.enabled(endpoint):
+            return None
+        counters = self.counters[endpoint]
+
+        entry = self.memory.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self.memory.move_to_end(key)
+                counters["hits"] += 1
+                counters["memory_hits"] += 1
+                return value
+            self._drop_memory(key)
+
+        value = await asyncio.to_thread(self._read_disk, endpoint, key)
+        if value is not None:
+            counters["hits"] += 1
+            counters["disk_hits"] += 1
+            return value
+
+        counters["misses"] += 1
+        return None
+
+    async def set(self, endpoint: str, key: str, value):
+        """
+        Stores a str or bytes-like result under the endpoint's TTL.
+        """
+        if not self.enabled(endpoint) or value is None:
+            return
+        if isinstance(value, (bytes, bytearray, memoryview)) and len(value) >= self.disk_threshold:
+            # Written as is: the caller's buffer is not modified afterwards, so no copy is needed
+            await asyncio.to_thread(self._write_disk, endpoint, key, value)
+            return
+
+        size = len(value)
+        if size > self.max_memory_bytes:
+            return
+        self._drop_memory(key)
+        self.memory[key] = (time.time() + self.ttls[endpoint], value)
+        self.memory_bytes += size
+        while len(self.memory) > self.max_entries or self.memory_bytes > self.max_memory_bytes:
+            oldest = next(iter(self.memory))
+            self._drop_memory(oldest)
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters per endpoint plus current tier sizes.
+        """
+        return {
+            "endpoints": {name: dict(values) for name, values in self.counters.items()},
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+        }
+
+    def _drop_memory(self, key):
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= len(entry[1])
+
+    # --- Disk tier (runs in a worker thread) ---
+
+    def _path(self, endpoint, key):
+        return os.path.join(self.directory, f"{endpoint}-{key}.bin")
+
+    def _read_disk(self, endpoint, key):
+        path = self._path(endpoint, key)
+        try:
+            # mtime is the write time, so entries expire a fixed TTL after they were stored
+            written = os.stat(path).st_mtime
+            if written + self.ttls[endpoint] < time.time():
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # Record the access in atime for eviction, leaving mtime alone
+            os.utime(path, (time.time(), written))
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning(f"Could not read cache file {path}: {e}")
+            return None
+
+    def _write_disk(self, endpoint, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(endpoint, key)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning(f"Could not write cache file {path}: {e}")
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".bin"):
+                stat = entry.stat()
+                # Least recently used first: atime is set on every hit, and on write like mtime
+                files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+                total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+_cache = None
+
+def get_cache() -> ResponseCache:
+    """
+    Returns the process-wide response cache.
+    """
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
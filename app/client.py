@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import aiohttp
+
+import config
+
+# --- Connection pool settings (override any of them in config.py) ---
+# Point this at a local stand-in (see bench/) to run without the real API
+GEMINI_BASE_URL = getattr(config, "GEMINI_BASE_URL", "https://generativelanguage.googleapis.com")
+POOL_SIZE = getattr(config, "GEMINI_POOL_SIZE", 100)
+POOL_SIZE_PER_HOST = getattr(config, "GEMINI_POOL_SIZE_PER_HOST", 50)
+KEEPALIVE_TIMEOUT = getattr(config, "GEMINI_KEEPALIVE_TIMEOUT", 75)
+DNS_CACHE_TTL = getattr(config, "GEMINI_DNS_CACHE_TTL", 300)
+WARMUP_CONNECTIONS = getattr(config, "GEMINI_WARMUP_CONNECTIONS", 2)
+REQUEST_TIMEOUT = getattr(config, "GEMINI_REQUEST_TIMEOUT", 60)
+
+log = logging.getLogger(__name__)
+
+
+class GeminiClient:
+    """
+    One long-lived aiohttp session shared by every call to the Gemini APIs.
+    Keeps TCP/TLS connections to generativelanguage.googleapis.com alive between requests.
+    """
+
+    def __init__(self, base_url=GEMINI_BASE_URL, pool_size=POOL_SIZE, pool_size_per_host=POOL_SIZE_PER_HOST,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, dns_cache_ttl=DNS_CACHE_TTL, timeout=REQUEST_TIMEOUT):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Returns the shared session, creating it on first use.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def start(self, warmup_connections=WARMUP_CONNECTIONS):
+        """
+        Opens the session and pre-connects a few sockets so the first user request skips the handshake.
+        """
+        session = self.session
+        if warmup_connections > 0:
+            await asyncio.gather(*(self._preconnect(session) for _ in range(warmup_connections)))
+        log.info(f"Gemini client started (pool={self.pool_size}, per_host={self.pool_size_per_host}).")
+
+    async def _preconnect(self, session):
+        try:
+            async with session.get(self.base_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                await response.read()
+        except Exception as e:
+            log.warning(f"Gemini client warm-up failed: {e}")
+
+    def post(self, url, **kwargs):
+        """
+        Sends a POST request through the pooled session. Usable both with `await` and `async with`.
+        """
+        return self.session.post(url, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            log.info("Gemini client closed.")
+        self._session = None
+
+
+_client = None
+
+def get_client() -> GeminiClient:
+    """
+    Returns the process-wide Gemini client.
+    """
+    global _client
+    if _client is None:
+        _client = GeminiClient()
+    return _client
+
+async def start_client():
+    await get_client().start()
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import select, update, insert
+
+import config
+from app.database.models import async_session, User, Order, GenerationJob
+from app.database.requests import prices
+from app.database.user_cache import user_cache
+
+# --- Ledger settings (override any of them in config.py) ---
+LEDGER_MAX_BATCH = getattr(config, "LEDGER_MAX_BATCH", 200)
+LEDGER_FLUSH_INTERVAL = getattr(config, "LEDGER_FLUSH_INTERVAL", 2.0)
+
+log = logging.getLogger(__name__)
+
+
+class UsageLedger:
+    """
+    Write-behind buffer for billing.
+    Generations are recorded in memory and written to `orders` and user balances in one transaction
+    per batch, when the buffer is full or every LEDGER_FLUSH_INTERVAL seconds.
+    Balance checks subtract charges that are still buffered, so they never see stale money.
+    A balance is never taken below zero; generations it can't cover are stored as unpaid orders.
+    """
+
+    def __init__(self, max_batch=LEDGER_MAX_BATCH, flush_interval=LEDGER_FLUSH_INTERVAL):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.entries = []
+        # tg_id -> cost (minor units) recorded but not yet committed
+        self.pending_cost = defaultdict(int)
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task = None
+
+    async def record(self, tg_id, model_name, units, latency=0.0, job_id=None):
+        """
+        Buffers one generation. Returns its cost in minor units.
+        When job_id is given, that durable job is marked done in the same transaction that bills it.
+        """
+        price = await prices.get(model_name) or 0
+        cost = int((Decimal(price) * Decimal(str(units))).to_integral_value())
+        self.entries.append({
+            "tg_id": tg_id,
+            "model": model_name,
+            "units": units,
+            "latency": latency,
+            "cost": cost,
+            "job_id": job_id,
+            "created_at": datetime.now(),
+        })
+        self.pending_cost[tg_id] += cost
+        if len(self.entries) >= self.max_batch:
+            self._full.set()
+        return cost
+
+    async def available_balance(self, tg_id):
+        """
+        Returns the committed balance minus charges still waiting in the buffer, or None for unknown users.
+        """
+        # Holding the flush lock keeps a batch from committing between reading the row and the buffer
+        async with self._flush_lock:
+            async with async_session() as session:
+                balance = await session.scalar(select(User.balance).where(User.tg_id == tg_id))
+            if balance is None:
+                return None
+            return balance - self.pending_cost.get(tg_id, 0)
+
+    async def can_afford(self, tg_id, model_name, units):
+        price = await prices.get(model_name) or 0
+        cost = int((Decimal(price) * Decimal(str(units))).to_integral_value())
+        balance = await self.available_balance(tg_id)
+        return balance is not None and balance >= cost
+
+    async def flush(self):
+        """
+        Writes every buffered entry in a single transaction.
+        """
+        async with self._flush_lock:
+            if not self.entries:
+                return
+            entries, self.entries = self.entries, []
+            self._full.clear()
+
+            totals = defaultdict(int)
+            for entry in entries:
+                totals[entry["tg_id"]] += entry["cost"]
+
+            try:
+                async with async_session() as session:
+                    # A job is billed only by the flush that moves it to done; replays in other processes skip it
+                    billable = []
+                    for entry in entries:
+                        if entry["job_id"] is not None:
+                            result = await session.execute(
+                                update(GenerationJob)
+                                .where(GenerationJob.id == entry["job_id"], GenerationJob.status != 'done')
+                                .values(status='done')
+                            )
+                            if result.rowcount != 1:
+                                continue
+                        billable.append(entry)
+                    tg_ids = {entry["tg_id"] for entry in billable}
+                    rows = await session.execute(select(User.tg_id, User.id).where(User.tg_id.in_(tg_ids)))
+                    user_ids = dict(rows.all())
+                    # Entries are charged one by one in the order they happened, each only if the balance
+                    # still covers it (the guard requests.calculate() uses), so batching never changes the result
+                    users = User.__table__
+                    orders, unpaid = [], 0
+                    for entry in billable:
+                        if entry["tg_id"] not in user_ids:
+                            continue
+                        paid = True
+                        if entry["cost"]:
+                            result = await session.execute(
+                                update(users).where(users.c.tg_id == entry["tg_id"], users.c.balance >= entry["cost"])
+                                .values(balance=users.c.balance - entry["cost"])
+                            )
+                            paid = result.rowcount == 1
+                        unpaid += not paid
+                        orders.append({
+                            # Unpaid orders keep a record of generations the balance couldn't cover
+                            "status": "done" if paid else "unpaid",
+                            "user": user_ids[entry["tg_id"]],
+                            "amount": entry["cost"],
+                            "created_at": entry["created_at"],
+                            "order": f"{entry['model']}:{entry['units']}:{entry['latency']:.2f}s"[:100],
+                        })
+                    if orders:
+                        await session.execute(insert(Order), orders)
+                    await session.commit()
+            except Exception as e:
+                # Put the batch back so nothing is lost; it will be retried on the next flush
+                log.error(f"Usage ledger flush failed, keeping {len(entries)} entries: {e}")
+                self.entries[:0] = entries
+                return
+
+            user_cache.invalidate(*totals)
+            for tg_id, cost in totals.items():
+                self.pending_cost[tg_id] -= cost
+                if self.pending_cost[tg_id] <= 0:
+                    del self.pending_cost[tg_id]
+            skipped = len(billable) - len(orders)
+            if skipped:
+                log.warning(f"Usage ledger skipped {skipped} entries for unregistered users.")
+            if unpaid:
+                log.warning(f"Usage ledger stored {unpaid} unpaid orders for users with too low a balance.")
+            if len(billable) < len(entries):
+                log.info(f"Usage ledger skipped {len(entries) - len(billable)} jobs that were already billed.")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stops the background flusher and writes whatever is still buffered.
+        """
+        if self._task is not None:
+            # Under the flush lock the task can't be in the middle of a flush, holding a swapped-out batch
+            async with self._flush_lock:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+ledger = UsageLedger()
@@ -1,13 +1,42 @@
 #This file is useless since the AI is free and there are no any instructions how to connect this file to postgresql
 
-from sqlalchemy import ForeignKey, String, BigInteger
+from sqlalchemy import ForeignKey, String, BigInteger, Text, event
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 from datetime import datetime
+from decimal import Decimal
+import logging
 
-engine = create_async_engine(url='sqlite+aiosqlite:///db.sqlite3', echo=True)
+import config
+
+DATABASE_URL = getattr(config, "DATABASE_URL", 'sqlite+aiosqlite:///db.sqlite3')
+DB_ECHO = getattr(config, "DB_ECHO", False)
+DB_POOL_SIZE = getattr(config, "DB_POOL_SIZE", 5)
+DB_MAX_OVERFLOW = getattr(config, "DB_MAX_OVERFLOW", 10)
+
+# Money is stored as integer minor units: 1 unit of balance = 1_000_000 minor units
+MINOR_UNITS = 1_000_000
+
+log = logging.getLogger(__name__)
+
+engine = create_async_engine(url=DATABASE_URL, echo=DB_ECHO, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
 async_session=async_sessionmaker(engine)
 
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run while a writer holds the lock; busy_timeout makes writers wait instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+def to_minor_units(amount) -> int:
+    return int((Decimal(str(amount)) * MINOR_UNITS).to_integral_value())
+
+def from_minor_units(amount: int) -> Decimal:
+    return Decimal(amount) / MINOR_UNITS
+
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
@@ -15,8 +44,9 @@ class User(Base):
     __tablename__='users'
     
     id: Mapped[int] = mapped_column(primary_key=True)
-    tg_id = mapped_column(BigInteger)
-    balance: Mapped[str] = mapped_column(String(15))
+    tg_id = mapped_column(BigInteger, unique=True, index=True)
+    balance: Mapped[int] = mapped_column(BigInteger, default=0)
+    is_active: Mapped[bool] = mapped_column(default=True)
     
 class AiType(Base):
     __tablename__ = 'ai_types'
@@ -28,9 +58,9 @@ class AiModel(Base):
     __tablename__ = 'ai_models'
     
     id: Mapped[int] = mapped_column(primary_key=True)
-    name: Mapped[str] = mapped_column(String(25))
+    name: Mapped[str] = mapped_column(String(25), unique=True, index=True)
     ai_type: Mapped[int] = mapped_column(ForeignKey('ai_types.id'))
-    price: Mapped[str] = mapped_column(String(25))
+    price: Mapped[int] = mapped_column(BigInteger)
 
 class Order(Base):
     __tablename__ = 'orders'
@@ -38,10 +68,163 @@ class Order(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     status: Mapped[str] = mapped_column(String(50))
     user: Mapped[int] = mapped_column(ForeignKey('users.id'))
-    amount: Mapped[str] = mapped_column(String(15))
+    amount: Mapped[int] = mapped_column(BigInteger)
     created_at: Mapped[datetime]
     order: Mapped[str] = mapped_column(String(100))
 
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    from_chat_id = mapped_column(BigInteger)
+    message_id: Mapped[int]
+    admin_chat_id = mapped_column(BigInteger)
+    status: Mapped[str] = mapped_column(String(20), default='running')
+    last_user_id: Mapped[int] = mapped_column(default=0)
+    sent: Mapped[int] = mapped_column(default=0)
+    failed: Mapped[int] = mapped_column(default=0)
+    blocked: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+    # The process sending the broadcast renews this while it runs; others resume it only once it lapses
+    lease_until: Mapped[datetime | None]
+
+class FsmState(Base):
+    __tablename__ = 'fsm_states'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str | None] = mapped_column(String(255))
+    data: Mapped[str] = mapped_column(Text, default='{}')
+
+class GenerationJob(Base):
+    __tablename__ = 'jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    idempotency_key: Mapped[str] = mapped_column(String(64), unique=True, index=True)
+    kind: Mapped[str] = mapped_column(String(10))
+    tg_id = mapped_column(BigInteger)
+    chat_id = mapped_column(BigInteger)
+    payload: Mapped[str] = mapped_column(Text)
+    # pending (replaying once claimed after a restart) -> answered (replied, charge queued) -> done (charged),
+    # or cancelled/failed
+    status: Mapped[str] = mapped_column(String(20), default='pending', index=True)
+    result: Mapped[str | None] = mapped_column(Text)
+    attempts: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now, onupdate=datetime.now)
+
+class Conversation(Base):
+    __tablename__ = 'conversations'
+
+    tg_id = mapped_column(BigInteger, primary_key=True)
+    summary: Mapped[str] = mapped_column(Text, default='')
+    # JSON list of [role, text] pairs, oldest first
+    turns: Mapped[str] = mapped_column(Text, default='[]')
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now, onupdate=datetime.now, index=True)
+
+# --- Schema migrations for existing db.sqlite3 files ---
+
+def _columns(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+def _add_column(table, column, ddl):
+    """
+    Migration step that adds a column unless the table already has it.
+    """
+    def step(conn):
+        if column not in _columns(conn, table):
+            conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN "{column}" {ddl}')
+    return step
+
+def _rebuild_table(table, conversions):
+    """
+    Migration step that recreates a table from its current model (SQLite can't change column types)
+    and copies the rows over, converting columns with the given SQL expressions.
+    """
+    def step(conn):
+        model_table = Base.metadata.tables[table]
+        old_columns = _columns(conn, table)
+        # Keep foreign keys in other tables pointing at the new table after the rename
+        conn.exec_driver_sql("PRAGMA legacy_alter_table=ON")
+        for index in model_table.indexes:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+        conn.exec_driver_sql(f"ALTER TABLE {table} RENAME TO {table}_old")
+        model_table.create(conn)
+        copied = [column.name for column in model_table.columns if column.name in old_columns]
+        names = ", ".join(f'"{name}"' for name in copied)
+        values = ", ".join(conversions.get(name, f'"{name}"') for name in copied)
+        conn.exec_driver_sql(f"INSERT INTO {table} ({names}) SELECT {values} FROM {table}_old")
+        conn.exec_driver_sql(f"DROP TABLE {table}_old")
+        conn.exec_driver_sql("PRAGMA legacy_alter_table=OFF")
+    return step
+
+def _merge_duplicate_users(conn):
+    """
+    Migration step that adds the balances of duplicate user rows to the oldest row with the same tg_id,
+    points their orders at it and deletes them. Rows without a tg_id are left alone.
+    """
+    conn.exec_driver_sql(
+        "CREATE TEMP TABLE user_merge AS "
+        "SELECT users.id AS old_id, kept.id AS new_id FROM users "
+        "JOIN (SELECT tg_id, MIN(id) AS id FROM users WHERE tg_id IS NOT NULL GROUP BY tg_id) AS kept "
+        "ON kept.tg_id = users.tg_id AND kept.id != users.id"
+    )
+    # Balances are still strings here; the next migration converts them to minor units
+    conn.exec_driver_sql(
+        "UPDATE users SET balance = CAST(COALESCE(balance, 0) AS REAL) + "
+        "(SELECT SUM(CAST(COALESCE(duplicate.balance, 0) AS REAL)) FROM user_merge "
+        "JOIN users AS duplicate ON duplicate.id = user_merge.old_id WHERE user_merge.new_id = users.id) "
+        "WHERE id IN (SELECT new_id FROM user_merge)"
+    )
+    conn.exec_driver_sql(
+        'UPDATE orders SET "user" = (SELECT new_id FROM user_merge WHERE old_id = orders."user") '
+        'WHERE "user" IN (SELECT old_id FROM user_merge)'
+    )
+    conn.exec_driver_sql("DELETE FROM users WHERE id IN (SELECT old_id FROM user_merge)")
+    conn.exec_driver_sql("DROP TABLE user_merge")
+
+def _to_minor_units_sql(column):
+    return f'CAST(ROUND(CAST(COALESCE("{column}", 0) AS REAL) * {MINOR_UNITS}) AS INTEGER)'
+
+# Each entry upgrades the schema by one version; the current version is kept in PRAGMA user_version.
+# A step is either an SQL statement or a callable that receives the connection.
+MIGRATIONS = [
+    [
+        # Fold duplicate users into the oldest row per tg_id and keep one model per name,
+        # so the unique indexes can be created
+        _merge_duplicate_users,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_tg_id ON users (tg_id)",
+        "DELETE FROM ai_models WHERE id NOT IN (SELECT MIN(id) FROM ai_models GROUP BY name)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_ai_models_name ON ai_models (name)",
+        _add_column("users", "is_active", "BOOLEAN NOT NULL DEFAULT 1"),
+    ],
+    [
+        # Money columns move from strings to integer minor units
+        _rebuild_table("users", {"balance": _to_minor_units_sql("balance")}),
+        _rebuild_table("ai_models", {"price": _to_minor_units_sql("price")}),
+        _rebuild_table("orders", {"amount": _to_minor_units_sql("amount")}),
+    ],
+    [
+        _add_column("broadcasts", "lease_until", "DATETIME"),
+    ],
+]
+
+def _migrate(conn):
+    fresh = not conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type='table' AND name='users'").first()
+    Base.metadata.create_all(conn)
+    if fresh:
+        conn.exec_driver_sql(f"PRAGMA user_version={len(MIGRATIONS)}")
+        return
+
+    version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info(f"Migrating database schema to version {number}...")
+        for statement in statements:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.exec_driver_sql(statement)
+        conn.exec_driver_sql(f"PRAGMA user_version={number}")
+
 async def async_main():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(_migrate)
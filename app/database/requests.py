@@ -1,9 +1,18 @@
 #This file is useless since the AI is free and there are no any instructions how to connect this file to postgresql
 
-from app.database.models import async_session
-from app.database.models import User, AiModel
-from sqlalchemy import select, update, delete, desc
+from app.database.models import async_session, to_minor_units
+from app.database.models import User, AiModel, Broadcast
+from app.database.user_cache import user_cache, CachedUser
+from sqlalchemy import select, update, delete, desc, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime
 from decimal import Decimal
+import time
+
+import config
+
+# Seconds before the in-memory price table is re-read from the database
+PRICE_REFRESH_INTERVAL = getattr(config, "PRICE_REFRESH_INTERVAL", 300)
 
 def connection(func):
     async def inner(*args, **kwargs):
@@ -11,23 +20,145 @@ def connection(func):
             return await func(session, *args, **kwargs)
     return inner
 
-async def set_user(tg_id, session):
+@connection
+async def set_user(session, tg_id):
+    """
+    Registers the user if needed (re-activating users who had blocked the bot) and returns a CachedUser.
+    """
     user = await session.scalar(select(User).where(User.tg_id == tg_id))
-        
+
     if not user:
-        session.add(User(tg_id=tg_id, balance='0'))
+        # Two updates from a new user can race here; the unique index lets the second insert be ignored
+        await session.execute(sqlite_insert(User).values(tg_id=tg_id, balance=0, is_active=True).on_conflict_do_nothing())
         await session.commit()
+        user = await session.scalar(select(User).where(User.tg_id == tg_id))
 
-         
-async def get_user(tg_id, session):
+    record = CachedUser(user.id, user.tg_id, user.balance)
+    if not user.is_active:
+        user.is_active = True
+        await session.commit()
+    user_cache.put(record)
+    return record
+
+@connection
+async def get_user(session, tg_id):
     return await session.scalar(select(User).where(User.tg_id == tg_id))
 
-async def get_users(session):
-    return await session.scalars(select(User))
+async def get_known_user(tg_id):
+    """
+    Returns the CachedUser for tg_id, touching the database only on a cache miss.
+    """
+    return user_cache.get(tg_id) or await set_user(tg_id)
+
+async def get_users(after_id=0, batch_size=1000, active_only=False):
+    """
+    Yields users in id order, fetching batch_size rows per query.
+    Uses keyset pagination, so no read transaction stays open between batches.
+    """
+    while True:
+        async with async_session() as session:
+            query = select(User).where(User.id > after_id).order_by(User.id).limit(batch_size)
+            if active_only:
+                query = query.where(User.is_active)
+            batch = (await session.scalars(query)).all()
+        if not batch:
+            return
+        for user in batch:
+            yield user
+        after_id = batch[-1].id
     
-async def calculate(tg_id, session, sum, model_name):
-    user = await session.scalar(select(User).where(User.tg_id == tg_id))
-    model = await session.scalar(select(AiModel).where(AiModel.name == model_name))
-    new_balance = Decimal(Decimal(user.balance) - (Decimal(model.price) * Decimal(sum)))
-    await session.execute(update(User).where(User.id == user.id).values(balance=str(new_balance)))
-    await session.commit()
\ No newline at end of file
+# --- Model prices ---
+
+class PriceTable:
+    """
+    In-memory copy of ai_models.name -> price (minor units).
+    Reloaded when a price changes through set_model_price() or after PRICE_REFRESH_INTERVAL.
+    """
+
+    def __init__(self, refresh_interval=PRICE_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.prices = {}
+        self.loaded_at = None
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    async def get(self, model_name):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh_interval:
+            async with async_session() as session:
+                rows = await session.execute(select(AiModel.name, AiModel.price))
+                self.prices = dict(rows.all())
+            self.loaded_at = time.monotonic()
+        return self.prices.get(model_name)
+
+prices = PriceTable()
+
+@connection
+async def set_model_price(session, model_name, price):
+    await session.execute(update(AiModel).where(AiModel.name == model_name).values(price=to_minor_units(price)))
+    await session.commit()
+    prices.invalidate()
+
+@connection
+async def calculate(session, tg_id, sum, model_name):
+    """
+    Charges the user for `sum` units of a model in one conditional UPDATE.
+    Returns False (and charges nothing) when the model is unknown or the balance is too low.
+    """
+    price = await prices.get(model_name)
+    if price is None:
+        return False
+    cost = int((Decimal(price) * Decimal(str(sum))).to_integral_value())
+    result = await session.execute(
+        update(User)
+        .where(User.tg_id == tg_id, User.balance >= cost)
+        .values(balance=User.balance - cost)
+    )
+    await session.commit()
+    user_cache.invalidate(tg_id)
+    return result.rowcount == 1
+
+
+# --- Newsletter broadcasts ---
+
+@connection
+async def count_active_users(session, after_id=0):
+    return await session.scalar(select(func.count(User.id)).where(User.is_active, User.id > after_id))
+
+@connection
+async def deactivate_users(session, user_ids):
+    await session.execute(update(User).where(User.id.in_(user_ids)).values(is_active=False))
+    await session.commit()
+
+@connection
+async def create_broadcast(session, from_chat_id, message_id, admin_chat_id, lease_until=None):
+    broadcast = Broadcast(from_chat_id=from_chat_id, message_id=message_id, admin_chat_id=admin_chat_id,
+                          lease_until=lease_until)
+    session.add(broadcast)
+    await session.flush()
+    broadcast_id = broadcast.id
+    await session.commit()
+    return broadcast_id
+
+@connection
+async def get_running_broadcasts(session):
+    return (await session.scalars(select(Broadcast).where(Broadcast.status == 'running'))).all()
+
+@connection
+async def claim_broadcast(session, broadcast_id, lease_until):
+    """
+    Takes over a running broadcast whose lease has lapsed. Returns False when another process holds it.
+    """
+    result = await session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id, Broadcast.status == 'running',
+               Broadcast.lease_until.is_(None) | (Broadcast.lease_until < datetime.now()))
+        .values(lease_until=lease_until)
+    )
+    await session.commit()
+    return result.rowcount == 1
+
+@connection
+async def save_broadcast_progress(session, broadcast_id, **values):
+    await session.execute(update(Broadcast).where(Broadcast.id == broadcast_id).values(**values))
+    await session.commit()
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import config
+
+# --- Known-user cache settings (override any of them in config.py) ---
+USER_CACHE_SIZE = getattr(config, "USER_CACHE_SIZE", 10000)
+USER_CACHE_TTL = getattr(config, "USER_CACHE_TTL", 300)
+
+
+class CachedUser(NamedTuple):
+    id: int
+    tg_id: int
+    balance: int
+
+
+class UserCache:
+    """
+    Bounded TTL/LRU map of tg_id -> CachedUser, so known users skip the database on every update.
+    Anything that changes a balance must call invalidate() for that user.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_id):
+        entry = self.entries.get(tg_id)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(tg_id)
+                self.hits += 1
+                return user
+            del self.entries[tg_id]
+        self.misses += 1
+        return None
+
+    def put(self, user: CachedUser):
+        self.entries[user.tg_id] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(user.tg_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *tg_ids):
+        for tg_id in tg_ids:
+            self.entries.pop(tg_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+user_cache = UserCache()
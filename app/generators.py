@@ -1,19 +1,70 @@
+import array
 import asyncio
 import logging
 import base64
+import hashlib
+import re
+import time
 from io import BytesIO
-import wave
-import aiohttp
 import json
 
-from aiogram.types import BufferedInputFile, PhotoSize
+from aiogram.types import PhotoSize
 from aiogram import Bot
-from config import AITOKEN
+try:
+    # Optional: only needed to downscale photos before analysis
+    from PIL import Image
+except ImportError:
+    Image = None
+import config
+from app.client import get_client, GEMINI_BASE_URL
+from app.keys import get_key_pool
+from app.limiter import get_limiter, parse_retry_after
+from app.hedging import race, DeadlineExceeded, LatencyTracker
+from app.cache import get_cache, make_key
+from app.singleflight import get_singleflight
+from app.streaming import split_point
+from app.imaging import postprocess_image, image_filename
+from app.payloads import read_base64_field, write_wav_header, MemoryInputFile, WAV_HEADER_SIZE
+from app.metrics import (UPSTREAM_LATENCY, UPSTREAM_RESPONSES, UPSTREAM_RETRIES, PAYLOAD_BYTES, TELEGRAM_DOWNLOAD,
+                         TEXT_HEDGES, TEXT_WINNERS, TEXT_CANCELLED, TEXT_DEADLINE_EXCEEDED)
 
 # --- API Constants ---
-GEMINI_FLASH_VISION_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={AITOKEN}"
-IMAGEN_3_URL = f"https://generativelanguage.googleapis.com/v1beta/models/imagen-3.0-generate-002:predict?key={AITOKEN}"
-TTS_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={AITOKEN}"
+GEMINI_FLASH_MODEL = "gemini-2.5-flash-preview-05-20"
+IMAGEN_3_MODEL = "imagen-3.0-generate-002"
+TTS_MODEL = "gemini-2.5-flash-preview-tts"
+
+# The API key goes in the x-goog-api-key header (see app/keys.py), never in the URL
+GEMINI_FLASH_VISION_URL = f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_FLASH_MODEL}:generateContent"
+IMAGEN_3_URL = f"{GEMINI_BASE_URL}/v1beta/models/{IMAGEN_3_MODEL}:predict"
+TTS_URL = f"{GEMINI_BASE_URL}/v1beta/models/{TTS_MODEL}:generateContent"
+
+# --- Latency budget for text chat ---
+# End-to-end seconds for one answer (time to the first chunk when streaming); None turns hedging and fallback off
+TEXT_DEADLINE = getattr(config, "TEXT_DEADLINE", 30.0)
+# A duplicate request goes out once the first is slower than this quantile of recent answers
+TEXT_HEDGE_QUANTILE = getattr(config, "TEXT_HEDGE_QUANTILE", 0.95)
+TEXT_HEDGE_MIN_DELAY = getattr(config, "TEXT_HEDGE_MIN_DELAY", 1.0)
+# After this fraction of the deadline the faster model is asked as well; None disables the fallback
+TEXT_FALLBACK_MODEL = getattr(config, "TEXT_FALLBACK_MODEL", "gemini-2.0-flash-lite")
+TEXT_FALLBACK_AFTER = getattr(config, "TEXT_FALLBACK_AFTER", 0.6)
+
+# Apologies sent instead of a text answer; conversation memory leaves them out of the history
+TEXT_TIMEOUT_REPLY = "Sorry, the text model is taking too long right now. Please try again in a moment."
+TEXT_EMPTY_REPLY = "Sorry, I couldn't get a response from the text model."
+TEXT_UNAVAILABLE_REPLY = "Sorry, I couldn't connect to the text generation service."
+TEXT_ERROR_REPLY = "An unexpected error occurred while processing your request."
+TEXT_ERROR_REPLIES = frozenset((TEXT_TIMEOUT_REPLY, TEXT_EMPTY_REPLY, TEXT_UNAVAILABLE_REPLY, TEXT_ERROR_REPLY))
+
+# Texts longer than this are spoken in chunks synthesized in parallel
+TTS_CHUNK_CHARS = getattr(config, "TTS_CHUNK_CHARS", 600)
+TTS_MAX_PARALLEL = getattr(config, "TTS_MAX_PARALLEL", 4)
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+# Photos are picked (and, with Pillow installed, downscaled) so their longer side is about this many pixels
+VISION_TARGET_SIDE = getattr(config, "VISION_TARGET_SIDE", 768)
+VISION_DOWNSCALE = getattr(config, "VISION_DOWNSCALE", True)
+VISION_JPEG_QUALITY = getattr(config, "VISION_JPEG_QUALITY", 85)
+DEFAULT_VISION_PROMPT = "Analyze this image and provide a detailed description of what you see."
 
 # All of the voice names available for TTS
 VOICES = [
@@ -23,84 +74,135 @@ VOICES = [
     'Pulcherrima', 'Achird', 'Zubenelgenubi', 'Vindemiatrix', 'Sadachbia', 'Sadaltager', 'Sulafat'
 ]
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
 log = logging.getLogger(__name__)
 
-# --- Helper function for exponential backoff ---
-async def with_exponential_backoff(api_call, max_retries=10, delay=2.0):
+# Recent answer times of the main text model, used to decide when to hedge
+_text_latency = LatencyTracker()
+_stream_latency = LatencyTracker()
+
+
+class UpstreamError(Exception):
     """
-    Handles API calls with exponential backoff to manage rate limiting.
-    Increased max_retries and initial delay to handle persistent rate-limiting.
+    The API answered with an error status (`status`) or without usable content (status None).
     """
-    for i in range(max_retries):
-        try:
-            response = await api_call()
-            if response and response.status == 429:
-                log.warning(f"API call failed with status 429. Retrying in {delay}s...")
-                await asyncio.sleep(delay)
-                delay *= 2
-            else:
-                return response
-        except Exception as e:
-            log.error(f"API call failed with error: {e}")
-            await asyncio.sleep(delay)
-            delay *= 2
-    raise Exception(f"API call failed after {max_retries} retries.")
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
 
 # --- API Call Functions ---
 
-async def handle_generate_image(prompt: str, bot: Bot):
+async def _call_api(limiter_name: str, api_call, request_bytes: int, endpoint: str = None):
+    """
+    Runs `api_call` (a coroutine function taking the API key headers) under the endpoint's limiter
+    and records latency, status and response size of every attempt, plus the retries the limiter made.
+    For streams the latency is time to headers.
+    Each attempt takes a key from the key pool; a 429 quarantines that key and the request moves
+    straight to the next healthy one, so the limiter only backs off once every key is throttled.
+    """
+    endpoint = endpoint or limiter_name
+    PAYLOAD_BYTES.observe(request_bytes, endpoint=endpoint, direction="request")
+    keys = get_key_pool()
+    attempts = 0
+
+    async def attempt():
+        nonlocal attempts
+        while True:
+            attempts += 1
+            if attempts > 1:
+                UPSTREAM_RETRIES.inc(endpoint=endpoint)
+            key = keys.acquire()
+            started = time.perf_counter()
+            try:
+                response = await api_call(key.headers)
+            except Exception:
+                keys.release(key)
+                UPSTREAM_RESPONSES.inc(endpoint=endpoint, status="error")
+                raise
+            except BaseException:
+                keys.release(key)
+                raise
+            finally:
+                UPSTREAM_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+            keys.release(key, response.status, parse_retry_after(response.headers.get("Retry-After")))
+            UPSTREAM_RESPONSES.inc(endpoint=endpoint, status=response.status)
+            if response.status == 429 and keys.has_healthy():
+                keys.failovers += 1
+                response.release()
+                continue
+            if response.content_length is not None:
+                PAYLOAD_BYTES.observe(response.content_length, endpoint=endpoint, direction="response")
+            return response
+
+    return await get_limiter(limiter_name).call(attempt)
+
+async def handle_generate_image(prompt: str, bot: Bot, use_cache: bool = True):
     """
     Generates an image from a text prompt using the Imagen 3 API.
-    Returns a BufferedInputFile object with the image data or an error string.
+    Returns a MemoryInputFile object with the image data or an error string.
+    Pass use_cache=False to always ask the API for a fresh image.
     """
     if not prompt:
         prompt = "A serene landscape with a small wooden cabin."
 
+    cache_key = make_key("imagen", IMAGEN_3_MODEL, prompt, sampleCount=1)
+    if use_cache:
+        cached = await get_cache().get("imagen", cache_key)
+        if cached is not None:
+            return MemoryInputFile(cached, filename=image_filename(cached))
+
+    # Identical prompts sent at the same time share one upstream request
+    result = await get_singleflight().do(cache_key, lambda: _request_image(prompt, cache_key, use_cache))
+    if isinstance(result, str):
+        return result
+    return MemoryInputFile(result, filename=image_filename(result))
+
+async def _request_image(prompt: str, cache_key: str, use_cache: bool):
+    """
+    Calls the Imagen API. Returns the image, re-encoded for Telegram, or an error string.
+    """
     payload = {
         "instances": [{"prompt": prompt}],
         "parameters": {"sampleCount": 1}
     }
 
-    async def api_call(session):
-        return await session.post(IMAGEN_3_URL, json=payload, timeout=60)
+    async def api_call(headers):
+        return await get_client().post(IMAGEN_3_URL, json=payload, headers=headers)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            response = await with_exponential_backoff(lambda: api_call(session))
-
-            if response and response.status == 200:
-                result = await response.json()
-                if 'predictions' in result and len(result['predictions']) > 0 and result['predictions'][0].get('bytesBase64Encoded'):
-                    base64_data = result['predictions'][0]['bytesBase64Encoded']
-                    image_data = base64.b64decode(base64_data)
-                    return BufferedInputFile(image_data, filename="generated_image.png")
-                else:
-                    error_message = result.get('predictions', [{}])[0].get('error', {}).get('message', 'Unknown error')
-                    log.error(f"Image generation failed for prompt: '{prompt}'. API returned: {error_message}")
-                    return f"Sorry, the image model rejected that prompt: {error_message}"
+        response = await _call_api("imagen", api_call, len(prompt.encode()))
+
+        if response and response.status == 200:
+            # The image is decoded while the body streams in; `result` keeps the rest of the JSON
+            result, image_data = await read_base64_field(response, fields=("bytesBase64Encoded",))
+            if image_data:
+                # The PNG is often several MB; a JPEG/WebP under the byte budget uploads much faster
+                image_data = (await postprocess_image(image_data)).data
+                if use_cache:
+                    await get_cache().set("imagen", cache_key, image_data)
+                return image_data
             else:
-                error_details = await response.text()
-                log.error(f"Image generation API returned an error: {response.status}. Details: {error_details}")
-                return "Sorry, I couldn't connect to the image generation service."
+                error_message = result.get('predictions', [{}])[0].get('error', {}).get('message', 'Unknown error')
+                log.error(f"Image generation failed for prompt: '{prompt}'. API returned: {error_message}")
+                return f"Sorry, the image model rejected that prompt: {error_message}"
+        else:
+            error_details = await response.text()
+            log.error(f"Image generation API returned an error: {response.status}. Details: {error_details}")
+            return "Sorry, I couldn't connect to the image generation service."
     except Exception as e:
         log.error(f"Failed to generate image due to an unexpected error: {e}")
         return "An unexpected error occurred while trying to generate the image."
 
-async def handle_generate_speech(text: str, voice_name: str, bot: Bot):
+async def handle_generate_speech(text: str, voice_name: str, bot: Bot, use_cache: bool = True, on_first_chunk=None):
     """
     Converts text to speech and returns a WAV audio file buffer.
-    Returns a BufferedInputFile object with the audio data.
+    Returns a MemoryInputFile object with the audio data.
+    Pass use_cache=False to skip the response cache.
+    Long texts are synthesized in parallel chunks. With `on_first_chunk` (a coroutine function taking
+    a MemoryInputFile) the first chunk is handed over as soon as it is ready and the returned file
+    only covers the rest of the text.
     """
-    log.info(f"Received text: '{text}', voice_name: '{voice_name}'")
+    log.debug(f"Received text: '{text}', voice_name: '{voice_name}'")
 
     if not text:
         log.error("TTS request received with empty text.")
@@ -110,6 +212,123 @@ async def handle_generate_speech(text: str, voice_name: str, bot: Bot):
         log.error(f"Invalid voice name provided: {voice_name}")
         return None
 
+    cache_key = make_key("tts", TTS_MODEL, text, voice=voice_name)
+    if use_cache:
+        cached = await get_cache().get("tts", cache_key)
+        if cached is not None:
+            return MemoryInputFile(cached, filename="speech.wav")
+
+    chunks = _split_for_speech(text)
+    if not chunks:
+        log.error("TTS request received with only whitespace.")
+        return None
+    if on_first_chunk is not None and len(chunks) > 1:
+        # Not coalesced: every caller needs its own early chunk, and the partial result isn't cached
+        wav_data = await _synthesize_chunks(chunks, voice_name, on_first_chunk)
+    else:
+        wav_data = await get_singleflight().do(cache_key, lambda: _request_speech(chunks, voice_name, cache_key, use_cache))
+    if wav_data:
+        return MemoryInputFile(wav_data, filename="speech.wav")
+    return None
+
+def _split_for_speech(text: str, max_chars=TTS_CHUNK_CHARS):
+    """
+    Splits text into chunks of at most max_chars at paragraph, then sentence, then word boundaries.
+    """
+    chunks = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        for sentence in SENTENCE_END.split(paragraph.strip()):
+            while len(sentence) > max_chars:
+                split = split_point(sentence, max_chars)
+                head, sentence = sentence[:split].strip(), sentence[split:].strip()
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(head)
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current} {sentence}" if current else sentence
+        # Paragraph breaks are natural pauses, so close the chunk there once it has some length
+        if len(current) >= max_chars // 2:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk]
+
+async def _request_speech(chunks, voice_name: str, cache_key: str, use_cache: bool):
+    """
+    Synthesizes the chunks and returns the WAV file as a memoryview, or None on failure.
+    """
+    if len(chunks) == 1:
+        synthesized = await _synthesize(chunks[0], voice_name, reserve=WAV_HEADER_SIZE)
+        if synthesized is None:
+            return None
+        wav_data, sample_rate = synthesized
+        write_wav_header(wav_data, len(wav_data) - WAV_HEADER_SIZE, sample_rate)
+    else:
+        wav_data = await _synthesize_chunks(chunks, voice_name)
+    if wav_data is not None and use_cache:
+        await get_cache().set("tts", cache_key, wav_data)
+    return wav_data
+
+async def _synthesize_chunks(chunks, voice_name: str, on_first_chunk=None):
+    """
+    Synthesizes chunks concurrently (the tts limiter still sets the pace) and stitches the PCM in order.
+    """
+    semaphore = asyncio.Semaphore(TTS_MAX_PARALLEL)
+
+    async def synthesize(chunk):
+        async with semaphore:
+            return await _synthesize(chunk, voice_name)
+
+    tasks = [asyncio.create_task(synthesize(chunk)) for chunk in chunks]
+    try:
+        if on_first_chunk is not None:
+            first = await tasks[0]
+            if first is None:
+                return None
+            await on_first_chunk(MemoryInputFile(_stitch([first]), filename="speech-1.wav"))
+            parts = await asyncio.gather(*tasks[1:])
+        else:
+            parts = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if any(part is None for part in parts):
+        log.error(f"TTS failed for {sum(part is None for part in parts)} of {len(parts)} chunks.")
+        return None
+    return _stitch(parts)
+
+def _stitch(parts):
+    """
+    Joins (pcm, sample_rate) parts into one WAV buffer at the first part's sample rate.
+    """
+    sample_rate = parts[0][1]
+    pcm_parts = [pcm if rate == sample_rate else _resample(pcm, rate, sample_rate) for pcm, rate in parts]
+    wav_data = memoryview(bytearray(WAV_HEADER_SIZE + sum(len(pcm) for pcm in pcm_parts)))
+    offset = WAV_HEADER_SIZE
+    for pcm in pcm_parts:
+        wav_data[offset:offset + len(pcm)] = pcm
+        offset += len(pcm)
+    write_wav_header(wav_data, offset - WAV_HEADER_SIZE, sample_rate)
+    return wav_data
+
+def _resample(pcm, rate: int, target_rate: int):
+    # Nearest-sample conversion of 16-bit mono PCM; only used if the API mixes rates within one text
+    log.warning(f"TTS chunk came back at {rate} Hz instead of {target_rate} Hz, resampling.")
+    samples = array.array("h", bytes(pcm))
+    count = len(samples) * target_rate // rate
+    return array.array("h", (samples[index * rate // target_rate] for index in range(count))).tobytes()
+
+async def _synthesize(text: str, voice_name: str, reserve: int = 0):
+    """
+    Calls the TTS API once. Returns (PCM memoryview with `reserve` free bytes in front, sample rate)
+    or None on failure.
+    """
     payload = {
         "contents": [{"parts": [{"text": text}]}],
         "generationConfig": {
@@ -118,147 +337,447 @@ async def handle_generate_speech(text: str, voice_name: str, bot: Bot):
                 "voiceConfig": {"prebuiltVoiceConfig": {"voiceName": voice_name}}
             }
         },
-        "model": "gemini-2.5-flash-preview-tts"
+        "model": TTS_MODEL
     }
 
-    async def api_call(session):
-        return await session.post(TTS_URL, json=payload, timeout=60)
+    async def api_call(headers):
+        return await get_client().post(TTS_URL, json=payload, headers=headers)
 
     try:
-        log.info("Attempting TTS API call...")
-        async with aiohttp.ClientSession() as session:
-            response = await with_exponential_backoff(lambda: api_call(session))
-            
-            # Log the raw response details regardless of success
-            if response:
-                response_status = response.status
-                response_body = await response.text()
-                log.info(f"TTS API Response Status: {response_status}")
-                log.info(f"TTS API Response Body: {response_body}")
-
-            if response and response.status == 200:
-                result = await response.json()
-                log.info(f"Parsed JSON Result: {result}") # Log the full JSON result
-                try:
-                    part = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0]
-                    audio_data_b64 = part.get('inlineData', {}).get('data')
-                    mime_type = part.get('inlineData', {}).get('mimeType')
-
-                    if audio_data_b64 and mime_type:
-                        pcm_data = base64.b64decode(audio_data_b64)
-                        
-                        sample_rate = 24000
-                        try:
-                            rate_string = mime_type.split(';rate=')[-1]
-                            sample_rate = int(rate_string)
-                        except (ValueError, IndexError):
-                            log.warning(f"Could not parse sample rate from mimeType: {mime_type}. Using default {sample_rate} Hz.")
-
-                        buffer = BytesIO()
-                        with wave.open(buffer, 'wb') as wav_file:
-                            wav_file.setnchannels(1)
-                            wav_file.setsampwidth(2)
-                            wav_file.setframerate(sample_rate)
-                            wav_file.writeframes(pcm_data)
-                        
-                        buffer.seek(0)
-                        return BufferedInputFile(buffer.read(), filename="speech.wav")
-                    else:
-                        log.error("TTS API response missing audio data.")
-                        return None
-                except KeyError as e:
-                    log.error(f"Malformed API response, expected key not found: {e}")
+        log.debug("Attempting TTS API call...")
+        response = await _call_api("tts", api_call, len(text.encode()))
+        log.debug(f"TTS API Response Status: {response.status}")
+
+        if response and response.status == 200:
+            # PCM is decoded right behind the reserved bytes, so a WAV header can go in front without a copy
+            result, pcm_data = await read_base64_field(response, fields=("data",), reserve=reserve)
+            try:
+                part = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0]
+                mime_type = part.get('inlineData', {}).get('mimeType')
+
+                if pcm_data is not None and len(pcm_data) > reserve and mime_type:
+                    sample_rate = 24000
+                    try:
+                        rate_string = mime_type.split(';rate=')[-1]
+                        sample_rate = int(rate_string)
+                    except (ValueError, IndexError):
+                        log.warning(f"Could not parse sample rate from mimeType: {mime_type}. Using default {sample_rate} Hz.")
+                    return pcm_data, sample_rate
+                else:
+                    log.error("TTS API response missing audio data.")
                     return None
-            else:
-                error_details = await response.text()
-                log.error(f"TTS API returned a non-200 status code: {response.status}. Details: {error_details}")
+            except KeyError as e:
+                log.error(f"Malformed API response, expected key not found: {e}")
                 return None
+        else:
+            error_details = await response.text()
+            log.error(f"TTS API returned a non-200 status code: {response.status}. Details: {error_details}")
+            return None
     except Exception as e:
-        log.error(f"Failed to generate TTS after multiple retries: {e}")
+        log.error(f"Failed to generate TTS: {e}")
         return None
 
-async def gemini(prompt: str):
+async def gemini(prompt: str, use_cache: bool = True, history=None):
     """
     Performs a simple text-based chat with the Gemini model.
+    Pass use_cache=False to skip the response cache.
+    `history` is an optional (summary, [(role, text), ...]) pair of earlier turns (see app/memory.py).
+    The cache and request coalescing key covers the whole history, so only an identical conversation reuses an answer.
     """
     if not prompt:
         return "Please provide a prompt."
-    
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
 
-    async def api_call(session):
-        return await session.post(GEMINI_FLASH_VISION_URL, json=payload, timeout=60)
+    cache_key = _text_key(prompt, history)
+    if use_cache:
+        cached = await get_cache().get("text", cache_key)
+        if cached is not None:
+            return cached
+
+    return await get_singleflight().do(cache_key, lambda: _request_text(prompt, cache_key, use_cache, history))
+
+async def generate_text(prompt: str, use_cache: bool = True) -> str:
+    """
+    Like gemini(), but raises UpstreamError, DeadlineExceeded or RateLimitError instead of
+    answering with an apology. Meant for batch jobs that need to tell failures apart.
+    """
+    cache_key = make_key("text", GEMINI_FLASH_MODEL, prompt)
+    if use_cache:
+        cached = await get_cache().get("text", cache_key)
+        if cached is not None:
+            return cached
+
+    return await get_singleflight().do(f"{cache_key}:raw", lambda: _answer_text(prompt, cache_key, use_cache))
 
+def _text_key(prompt: str, history=None) -> str:
+    if not history:
+        return make_key("text", GEMINI_FLASH_MODEL, prompt)
+    summary, turns = history
+    context = hashlib.sha256(json.dumps([summary, list(turns)], ensure_ascii=False).encode()).hexdigest()
+    return make_key("text", GEMINI_FLASH_MODEL, prompt, context=context)
+
+def _text_payload(prompt: str, history=None) -> dict:
+    """
+    Builds a generateContent body: earlier turns in order, the summary of older ones as a system instruction.
+    """
+    if not history:
+        return {"contents": [{"parts": [{"text": prompt}]}]}
+    summary, turns = history
+    contents = [{"role": role, "parts": [{"text": text}]} for role, text in turns]
+    contents.append({"role": "user", "parts": [{"text": prompt}]})
+    payload = {"contents": contents}
+    if summary:
+        payload["systemInstruction"] = {"parts": [{"text": f"Summary of the earlier conversation with this user:\n{summary}"}]}
+    return payload
+
+def _payload_bytes(prompt: str, history=None) -> int:
+    if not history:
+        return len(prompt.encode())
+    summary, turns = history
+    return len(prompt.encode()) + len((summary or "").encode()) + sum(len(text.encode()) for _, text in turns)
+
+async def _request_text(prompt: str, cache_key: str, use_cache: bool, history=None):
+    """
+    Calls the text model. Returns the answer or a user-facing error message.
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            response = await with_exponential_backoff(lambda: api_call(session))
-            if response and response.status == 200:
-                result = await response.json()
-                text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text')
-                return text if text else "Sorry, I couldn't get a response from the text model."
-            else:
-                error_details = await response.text()
-                log.error(f"Gemini API returned a non-200 status code: {response.status}. Details: {error_details}")
-                return "Sorry, I couldn't connect to the text generation service."
+        return await _answer_text(prompt, cache_key, use_cache, history)
+    except DeadlineExceeded:
+        TEXT_DEADLINE_EXCEEDED.inc(endpoint="text")
+        log.warning(f"No text answer within {TEXT_DEADLINE}s.")
+        return TEXT_TIMEOUT_REPLY
+    except UpstreamError as e:
+        log.error(f"Gemini API failed: {e}")
+        if e.status is None:
+            return TEXT_EMPTY_REPLY
+        return TEXT_UNAVAILABLE_REPLY
     except Exception as e:
         log.error(f"Failed to chat with Gemini: {e}")
-        return "An unexpected error occurred while processing your request."
+        return TEXT_ERROR_REPLY
+
+async def _answer_text(prompt: str, cache_key: str, use_cache: bool, history=None) -> str:
+    """
+    Calls the text model and caches the answer. Raises on failure.
+    With TEXT_DEADLINE set, slow requests are hedged and fall back to TEXT_FALLBACK_MODEL.
+    """
+    payload = _text_payload(prompt, history)
+    request_bytes = _payload_bytes(prompt, history)
+
+    if TEXT_DEADLINE is None:
+        model, text = GEMINI_FLASH_MODEL, await _generate_text(GEMINI_FLASH_MODEL, payload, request_bytes)
+    else:
+        model, text = await _race_text(lambda model, limiter: _generate_text(
+            model, payload, request_bytes, limiter), _text_latency)
 
-async def handle_analyze_image(photo: PhotoSize, bot: Bot):
+    # Fallback answers are not cached under the main model's key
+    if use_cache and model == GEMINI_FLASH_MODEL:
+        await get_cache().set("text", cache_key, text)
+    return text
+
+async def _generate_text(model: str, payload: dict, request_bytes: int, limiter_name="text") -> str:
+    """
+    Calls generateContent once (with the limiter's retries). Returns the text or raises UpstreamError.
+    """
+    url = f"{GEMINI_BASE_URL}/v1beta/models/{model}:generateContent"
+
+    async def api_call(headers):
+        return await get_client().post(url, json=payload, headers=headers)
+
+    response = await _call_api(limiter_name, api_call, request_bytes)
+    try:
+        if response.status != 200:
+            raise UpstreamError(f"{model} returned {response.status}: {await response.text()}", response.status)
+        result = await response.json()
+    finally:
+        response.release()
+    text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text')
+    if not text:
+        raise UpstreamError(f"{model} returned no text.")
+    return text
+
+async def _race_text(attempt, tracker: LatencyTracker):
+    """
+    Races `attempt(model, limiter name)` calls: the main model now, a hedged duplicate once it is
+    slower than recent answers usually are, and the fallback model late in the budget.
+    Returns (model, result) of the first success. Requests still running at TEXT_DEADLINE are cancelled
+    rather than timed out, so abandoning them doesn't count against the limiter's circuit breaker.
+    """
+    loop = asyncio.get_running_loop()
+
+    def contender(name, model, limiter_name):
+        async def run():
+            if name != "primary":
+                TEXT_HEDGES.inc(kind=name)
+            result = await attempt(model, limiter_name)
+            return model, result
+        return run
+
+    contenders = [("primary", 0.0, contender("primary", GEMINI_FLASH_MODEL, "text"))]
+    hedge_after = max(TEXT_HEDGE_MIN_DELAY, tracker.quantile(TEXT_HEDGE_QUANTILE, default=TEXT_DEADLINE / 2))
+    # A duplicate only adds load while the API is throttling us or the circuit is open
+    if _healthy(get_limiter("text")) and hedge_after < TEXT_DEADLINE:
+        contenders.append(("hedge", hedge_after, contender("hedge", GEMINI_FLASH_MODEL, "text")))
+    if TEXT_FALLBACK_MODEL:
+        contenders.append(("fallback", TEXT_DEADLINE * TEXT_FALLBACK_AFTER,
+                           contender("fallback", TEXT_FALLBACK_MODEL, "text_fallback")))
+
+    # Latency is measured from the start of the whole request, whoever wins: a primary that lost or
+    # ran out of time was at least that slow, and leaving it out would pull the quantile down
+    started = loop.time()
+    try:
+        name, result = await race(contenders, TEXT_DEADLINE, discard=_discard_text_result,
+                                  on_cancel=lambda loser: TEXT_CANCELLED.inc(kind=loser))
+    except DeadlineExceeded:
+        tracker.observe(TEXT_DEADLINE)
+        raise
+    tracker.observe(loop.time() - started)
+    TEXT_WINNERS.inc(kind=name)
+    return result
+
+def _healthy(limiter) -> bool:
+    return limiter.breaker.state == "closed" and limiter.paused_until <= time.monotonic()
+
+def _discard_text_result(result):
+    # A stream that lost by a hair still holds a connection open
+    _, value = result
+    if isinstance(value, tuple):
+        asyncio.ensure_future(value[1].aclose())
+
+async def _iter_sse_events(response):
+    """
+    Yields the parsed JSON payload of every `data:` event in a server-sent events response.
+    """
+    data_lines = []
+    async for raw_line in response.content:
+        line = raw_line.decode('utf-8').rstrip('\r\n')
+        if line.startswith('data:'):
+            data_lines.append(line[5:].lstrip())
+        elif not line and data_lines:
+            yield json.loads('\n'.join(data_lines))
+            data_lines = []
+    if data_lines:
+        yield json.loads('\n'.join(data_lines))
+
+async def gemini_stream(prompt: str, use_cache: bool = True, history=None):
+    """
+    Streaming variant of gemini() built on streamGenerateContent.
+    Yields text chunks as soon as the model produces them.
+    A cached answer is yielded as a single chunk. `history` works as in gemini().
+    """
+    if not prompt:
+        yield "Please provide a prompt."
+        return
+
+    cache_key = _text_key(prompt, history)
+    if use_cache:
+        cached = await get_cache().get("text", cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    async for chunk in get_singleflight().do_stream(cache_key, lambda: _request_text_stream(prompt, cache_key, use_cache, history)):
+        yield chunk
+
+async def _request_text_stream(prompt: str, cache_key: str, use_cache: bool, history=None):
+    """
+    Calls streamGenerateContent and yields text chunks, or a single error message.
+    With TEXT_DEADLINE set, the time to the first chunk is hedged and falls back to TEXT_FALLBACK_MODEL;
+    once a stream has started it runs to the end.
+    """
+    payload = _text_payload(prompt, history)
+    request_bytes = _payload_bytes(prompt, history)
+
+    chunks = []
+    try:
+        try:
+            if TEXT_DEADLINE is None:
+                model, (first, stream) = GEMINI_FLASH_MODEL, await _open_text_stream(GEMINI_FLASH_MODEL, payload, request_bytes)
+            else:
+                model, (first, stream) = await _race_text(lambda model, limiter: _open_text_stream(
+                    model, payload, request_bytes, limiter), _stream_latency)
+        except DeadlineExceeded:
+            TEXT_DEADLINE_EXCEEDED.inc(endpoint="text_stream")
+            log.warning(f"No streamed text within {TEXT_DEADLINE}s.")
+            yield TEXT_TIMEOUT_REPLY
+            return
+        except UpstreamError as e:
+            log.error(f"Gemini streaming API failed: {e}")
+            if e.status is None:
+                yield TEXT_EMPTY_REPLY
+            else:
+                yield TEXT_UNAVAILABLE_REPLY
+            return
+
+        chunks.append(first)
+        yield first
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await stream.aclose()
+        if use_cache and model == GEMINI_FLASH_MODEL:
+            await get_cache().set("text", cache_key, "".join(chunks))
+    except Exception as e:
+        log.error(f"Failed to stream chat with Gemini: {e}")
+        if not chunks:
+            yield TEXT_ERROR_REPLY
+
+async def _open_text_stream(model: str, payload: dict, request_bytes: int, limiter_name="text"):
+    """
+    Starts a streamGenerateContent call and waits for its first text chunk.
+    Returns (first chunk, async iterator over the rest) or raises UpstreamError.
+    """
+    stream = _stream_text(model, payload, request_bytes, limiter_name)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        raise UpstreamError(f"{model} streamed no text.")
+    except BaseException:
+        await stream.aclose()
+        raise
+    return first, stream
+
+async def _stream_text(model: str, payload: dict, request_bytes: int, limiter_name="text"):
+    """
+    Yields the text parts of a streamGenerateContent response; raises UpstreamError on a non-200 status.
+    """
+    url = f"{GEMINI_BASE_URL}/v1beta/models/{model}:streamGenerateContent?alt=sse"
+
+    async def api_call(headers):
+        return await get_client().post(url, json=payload, headers=headers)
+
+    endpoint = "text_stream" if limiter_name == "text" else f"{limiter_name}_stream"
+    response = await _call_api(limiter_name, api_call, request_bytes, endpoint=endpoint)
+    try:
+        if response.status != 200:
+            raise UpstreamError(f"{model} returned {response.status}: {await response.text()}", response.status)
+        async for event in _iter_sse_events(response):
+            parts = event.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+            for part in parts:
+                if part.get('text'):
+                    yield part['text']
+    finally:
+        response.release()
+
+def pick_photo_size(sizes, target=VISION_TARGET_SIDE) -> PhotoSize:
+    """
+    Returns the smallest PhotoSize whose longer side reaches `target`, or the largest one when none does.
+    """
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if max(size.width, size.height) >= target:
+            return size
+    return ordered[-1]
+
+async def handle_analyze_image(photo: PhotoSize, bot: Bot, question: str = None, use_cache: bool = True):
     """
     Analyzes an image using the Gemini Vision model.
-    Downloads the image from Telegram, encodes it, and sends it to the API.
+    Downloads the image from Telegram, encodes it, and asks `question` about it (a general description by default).
     Returns a string with the analysis result or None on failure.
+    Answers are cached by the photo's file_unique_id, so forwarded or re-sent photos are answered instantly.
+    """
+    question = (question or "").strip() or DEFAULT_VISION_PROMPT
+    cache_key = make_key("vision", GEMINI_FLASH_MODEL, question, file=photo.file_unique_id)
+    if use_cache:
+        cached = await get_cache().get("vision", cache_key)
+        if cached is not None:
+            return cached
+
+    return await get_singleflight().do(cache_key, lambda: _request_analysis(photo, bot, question, cache_key, use_cache))
+
+def _encode_vision_request(image_data, question: str, target: int, downscale: bool) -> bytes:
+    """
+    Builds the JSON request body. Runs in a worker thread: downscaling, base64 and serialization are all CPU-bound.
+    """
+    # Telegram photos are JPEG; local files for batch jobs may be PNG
+    mime_type = "image/png" if bytes(image_data[:8]) == b"\x89PNG\r\n\x1a\n" else "image/jpeg"
+    if downscale and Image is not None:
+        image_data, mime_type = _downscale(image_data, target)
+    payload = {
+        "contents": [
+            {
+                "parts": [
+                    {"text": question},
+                    {"inlineData": {"mimeType": mime_type, "data": base64.b64encode(image_data).decode('ascii')}}
+                ]
+            }
+        ]
+    }
+    return json.dumps(payload).encode()
+
+def _downscale(image_data, target: int):
+    """
+    Shrinks an image so its longer side is at most `target` and re-encodes it as JPEG.
+    """
+    try:
+        with Image.open(BytesIO(image_data)) as image:
+            if max(image.size) <= target:
+                return image_data, Image.MIME.get(image.format, "image/jpeg")
+            image.thumbnail((target, target))
+            output = BytesIO()
+            image.convert("RGB").save(output, "JPEG", quality=VISION_JPEG_QUALITY)
+            return output.getbuffer(), "image/jpeg"
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        log.warning(f"Could not downscale image, sending the original: {e}")
+        return image_data, "image/jpeg"
+
+async def _request_analysis(photo: PhotoSize, bot: Bot, question: str, cache_key: str, use_cache: bool):
+    """
+    Downloads the photo and calls the vision model. Returns the answer or None on failure.
     """
     try:
-        # Download the photo from Telegram as a BytesIO object
+        # Download the photo from Telegram and use its buffer without copying it
         image_stream = BytesIO()
+        started = time.perf_counter()
         await bot.download(photo, destination=image_stream)
-        image_stream.seek(0)
-        
-        # Read the binary data and encode it to base64
-        image_data = image_stream.read()
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": "Analyze this image and provide a detailed description of what you see."
-                        },
-                        {
-                            "inlineData": {
-                                "mimeType": "image/jpeg",  # Telegram photos are typically JPEG
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }
-            ]
-        }
-        
-        async def api_call(session):
-            return await session.post(GEMINI_FLASH_VISION_URL, json=payload, timeout=60)
-        
-        async with aiohttp.ClientSession() as session:
-            response = await with_exponential_backoff(lambda: api_call(session))
-
-            if response and response.status == 200:
-                result = await response.json()
-                # The text is inside the 'parts' of the first candidate
-                analysis_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text')
-                if analysis_text:
-                    return analysis_text
-                else:
-                    log.error("Gemini Vision API response missing analysis text.")
-                    return None
+        TELEGRAM_DOWNLOAD.observe(time.perf_counter() - started)
+        image_data = image_stream.getbuffer()
+    except Exception as e:
+        log.error(f"Failed to download the photo to analyze: {e}")
+        return None
+    return await _analyze(image_data, question, cache_key, use_cache)
+
+async def analyze_image_data(image_data, question: str = None, use_cache: bool = True):
+    """
+    Analyzes an image given as bytes (e.g. a local file) with the Gemini Vision model.
+    Returns the answer or None on failure. Answers are cached by the image's content hash.
+    """
+    question = (question or "").strip() or DEFAULT_VISION_PROMPT
+    cache_key = make_key("vision", GEMINI_FLASH_MODEL, question, sha256=hashlib.sha256(image_data).hexdigest())
+    if use_cache:
+        cached = await get_cache().get("vision", cache_key)
+        if cached is not None:
+            return cached
+
+    return await get_singleflight().do(cache_key, lambda: _analyze(image_data, question, cache_key, use_cache))
+
+async def _analyze(image_data, question: str, cache_key: str, use_cache: bool):
+    """
+    Calls the vision model with an image. Returns the answer or None on failure.
+    """
+    try:
+        body = await asyncio.to_thread(_encode_vision_request, image_data, question, VISION_TARGET_SIDE, VISION_DOWNSCALE)
+
+        async def api_call(headers):
+            return await get_client().post(GEMINI_FLASH_VISION_URL, data=body, headers={**headers, "Content-Type": "application/json"})
+
+        response = await _call_api("vision", api_call, len(image_data))
+
+        if response and response.status == 200:
+            result = await response.json()
+            # The text is inside the 'parts' of the first candidate
+            analysis_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text')
+            if analysis_text:
+                if use_cache:
+                    await get_cache().set("vision", cache_key, analysis_text)
+                return analysis_text
             else:
-                error_details = await response.text()
-                log.error(f"Gemini Vision API returned a non-200 status code: {response.status}. Details: {error_details}")
+                log.error("Gemini Vision API response missing analysis text.")
                 return None
+        else:
+            error_details = await response.text()
+            log.error(f"Gemini Vision API returned a non-200 status code: {response.status}. Details: {error_details}")
+            return None
     except Exception as e:
         log.error(f"Failed to analyze image due to an unexpected error: {e}")
         return None
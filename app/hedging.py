@@ -0,0 +1,84 @@
+import asyncio
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _consume_exception(task: asyncio.Task):
+    # Losers may fail after the race is over; nobody awaits them anymore
+    if not task.cancelled():
+        task.exception()
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when no contender of a race produced a result before the deadline.
+    """
+
+
+class LatencyTracker:
+    """
+    Keeps the last `window` latencies of an operation and answers quantile queries over them.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.samples = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float, default=None):
+        """
+        Returns the q-quantile of recent latencies, or `default` until enough samples were seen.
+        """
+        if len(self.samples) < self.min_samples:
+            return default
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def race(contenders, deadline: float, discard=None, on_cancel=None):
+    """
+    Runs contenders and returns (name, result) of the first one to succeed.
+    `contenders` is a list of (name, start after seconds, coroutine function). Each is started at its
+    time, or earlier once everything started so far has failed. The losers are cancelled, and results
+    that finished in the same instant as the winner are handed to `discard`.
+    Raises DeadlineExceeded after `deadline` seconds, or the last error when every contender failed.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    pending = sorted(contenders, key=lambda contender: contender[1])
+    running = {}
+    last_error = None
+    try:
+        while True:
+            elapsed = loop.time() - started
+            if elapsed >= deadline:
+                raise DeadlineExceeded(f"No answer within {deadline:.1f}s.")
+            while pending and (pending[0][1] <= elapsed or not running):
+                name, _, func = pending.pop(0)
+                task = asyncio.ensure_future(func())
+                task.add_done_callback(_consume_exception)
+                running[task] = name
+
+            wake = min(deadline, pending[0][1]) if pending else deadline
+            done, _ = await asyncio.wait(running, timeout=max(0.0, wake - elapsed),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = running.pop(task)
+                if task.exception() is None:
+                    return name, task.result()
+                last_error = task.exception()
+                log.warning(f"Contender {name} failed: {last_error}")
+            if not running and not pending:
+                raise last_error
+    finally:
+        for task, name in running.items():
+            if not task.done():
+                task.cancel()
+                if on_cancel is not None:
+                    on_cancel(name)
+            elif not task.cancelled() and task.exception() is None and discard is not None:
+                discard(task.result())
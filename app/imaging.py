@@ -0,0 +1,141 @@
+import asyncio
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import time
+from typing import NamedTuple
+
+import config
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# --- Image post-processing settings (override any of them in config.py) ---
+# "JPEG" or "WEBP"; None sends the model's PNG unchanged
+IMAGE_FORMAT = getattr(config, "IMAGE_FORMAT", "JPEG")
+# Quality is lowered step by step (and the image shrunk as a last resort) until it fits the budget
+IMAGE_MAX_BYTES = getattr(config, "IMAGE_MAX_BYTES", 1024 * 1024)
+IMAGE_QUALITY = getattr(config, "IMAGE_QUALITY", 90)
+IMAGE_MIN_QUALITY = getattr(config, "IMAGE_MIN_QUALITY", 60)
+# "process" or "thread"
+IMAGE_POOL = getattr(config, "IMAGE_POOL", "process")
+IMAGE_WORKERS = getattr(config, "IMAGE_WORKERS", 2)
+
+log = logging.getLogger(__name__)
+
+
+class ProcessedImage(NamedTuple):
+    data: bytes
+    format: str
+    original_size: int
+    seconds: float
+
+
+def image_filename(data, stem="generated_image") -> str:
+    """
+    Names an encoded image after its actual format, sniffed from the magic bytes.
+    """
+    head = bytes(data[:12])
+    if head.startswith(b"\xff\xd8"):
+        return f"{stem}.jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return f"{stem}.webp"
+    return f"{stem}.png"
+
+
+def encode_image(data: bytes, image_format=IMAGE_FORMAT, max_bytes=IMAGE_MAX_BYTES, quality=IMAGE_QUALITY,
+                 min_quality=IMAGE_MIN_QUALITY):
+    """
+    Re-encodes an image under a byte budget. Pure CPU work, meant to run in a pool.
+    Returns (data, format).
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+
+    encoded = None
+    while True:
+        for current_quality in range(quality, min_quality - 1, -10):
+            encoded = _save(image, image_format, current_quality)
+            if len(encoded) <= max_bytes:
+                break
+        else:
+            if max(image.size) > 512:
+                # Still over budget at the lowest quality: shrink and try again
+                image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+                continue
+        break
+
+    return encoded, image_format
+
+def _save(image, image_format, quality) -> bytes:
+    output = io.BytesIO()
+    image.save(output, image_format, quality=quality, optimize=image_format == "JPEG")
+    return output.getvalue()
+
+
+# --- Pool ---
+
+_pool = None
+stats = {"images": 0, "original_bytes": 0, "encoded_bytes": 0, "encode_seconds": 0.0, "failures": 0}
+
+def get_pool() -> concurrent.futures.Executor:
+    """
+    Returns the process-wide pool for image encoding, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        if IMAGE_POOL == "process":
+            _pool = concurrent.futures.ProcessPoolExecutor(IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            _pool = concurrent.futures.ThreadPoolExecutor(IMAGE_WORKERS, thread_name_prefix="image")
+    return _pool
+
+def _reset_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        pool.shutdown(wait=False)
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await asyncio.to_thread(pool.shutdown)
+
+async def postprocess_image(data) -> ProcessedImage:
+    """
+    Converts a generated image to IMAGE_FORMAT under IMAGE_MAX_BYTES without blocking the event loop.
+    Falls back to the original bytes when the format is disabled, Pillow is missing or encoding fails.
+    """
+    original = ProcessedImage(data, "PNG", len(data), 0.0)
+    if IMAGE_FORMAT is None or Image is None:
+        return original
+
+    started = time.perf_counter()
+    try:
+        encoded, image_format = await asyncio.get_running_loop().run_in_executor(
+            get_pool(), encode_image, bytes(data))
+    except concurrent.futures.BrokenExecutor as e:
+        # A worker died (e.g. killed for memory); start a fresh pool for the next image
+        _reset_pool()
+        stats["failures"] += 1
+        log.error(f"Image pool broke, sending the original: {e}")
+        return original
+    except Exception as e:
+        stats["failures"] += 1
+        log.error(f"Image post-processing failed, sending the original: {e}")
+        return original
+    seconds = time.perf_counter() - started
+
+    if len(encoded) >= len(data):
+        # Already small enough; keep the lossless original
+        encoded, image_format = data, "PNG"
+    stats["images"] += 1
+    stats["original_bytes"] += len(data)
+    stats["encoded_bytes"] += len(encoded)
+    stats["encode_seconds"] += seconds
+    log.info(f"Image encoded as {image_format} in {seconds * 1000:.0f}ms: {len(data)} -> {len(encoded)} bytes.")
+    return ProcessedImage(encoded, image_format, len(data), seconds)
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile, PhotoSize
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import config
+from app.database.models import async_session, GenerationJob
+from app.database.ledger import ledger
+from app.generators import (gemini, handle_generate_image, handle_generate_speech, handle_analyze_image,
+                            GEMINI_FLASH_MODEL, IMAGEN_3_MODEL, TTS_MODEL, TEXT_ERROR_REPLIES)
+from app.scheduler import get_scheduler, JobCancelled
+from app.streaming import TELEGRAM_MESSAGE_LIMIT, split_point
+
+# --- Durable job settings (override any of them in config.py) ---
+JOB_MAX_ATTEMPTS = getattr(config, "JOB_MAX_ATTEMPTS", 3)
+# Seconds graceful shutdown waits for running jobs before leaving them for the next start
+SHUTDOWN_DRAIN_TIMEOUT = getattr(config, "SHUTDOWN_DRAIN_TIMEOUT", 20)
+# Seconds a pending job must sit untouched before a starting process replays it. Several webhook
+# processes share the database, so a younger job may still be running in another one
+JOB_REPLAY_AFTER = getattr(config, "JOB_REPLAY_AFTER", 300 if getattr(config, "RUN_MODE", "polling") == "webhook" else 0)
+
+log = logging.getLogger(__name__)
+
+
+class JobOutcome(NamedTuple):
+    """
+    What a finished job produced: the model and units to bill, and an optional text result.
+    """
+    model_name: str
+    units: int
+    started: float
+    result: Optional[str] = None
+
+
+def idempotency_key(chat_id, message_id) -> str:
+    # Telegram re-delivers the same message with the same ids, so this identifies a request across restarts
+    return f"{chat_id}:{message_id}"
+
+async def accept(key, kind, tg_id, chat_id, payload: dict):
+    """
+    Records an accepted job. Returns its id, or None when the same request was already accepted.
+    """
+    statement = sqlite_insert(GenerationJob).values(
+        idempotency_key=key, kind=kind, tg_id=tg_id, chat_id=chat_id,
+        payload=json.dumps(payload, ensure_ascii=False),
+    ).on_conflict_do_nothing()
+    async with async_session() as session:
+        result = await session.execute(statement)
+        await session.commit()
+        if result.rowcount == 0:
+            return None
+        return await session.scalar(select(GenerationJob.id).where(GenerationJob.idempotency_key == key))
+
+async def set_status(job_id, status, **values):
+    async with async_session() as session:
+        await session.execute(update(GenerationJob).where(GenerationJob.id == job_id).values(status=status, **values))
+        await session.commit()
+
+async def complete(job_id, tg_id, outcome: Optional[JobOutcome]):
+    """
+    Marks a job answered and queues its charge. The ledger flips the job to done in the same
+    transaction that bills it, so a replay never charges twice.
+    """
+    if outcome is None:
+        await set_status(job_id, 'failed')
+        return
+    latency = time.monotonic() - outcome.started
+    result = {"model": outcome.model_name, "units": outcome.units, "latency": latency, "text": outcome.result}
+    await set_status(job_id, 'answered', result=json.dumps(result, ensure_ascii=False))
+    await ledger.record(tg_id, outcome.model_name, outcome.units, latency, job_id=job_id)
+
+async def run(job_id, tg_id, kind, work, supersede=False, on_queued=None):
+    """
+    Runs `work()` (returning a JobOutcome or None) through the scheduler and records the outcome.
+    """
+    task = asyncio.current_task()
+    _in_flight.add(task)
+    try:
+        job = get_scheduler().submit(tg_id, kind, work, supersede=supersede)
+        if on_queued is not None and job.position > 0:
+            await on_queued(job.position)
+        try:
+            outcome = await job.wait()
+        except JobCancelled as e:
+            log.info(f"Job {job_id} for user {tg_id} ended early: {e}")
+            await set_status(job_id, 'cancelled')
+            return
+        except Exception:
+            # Left pending, the job would be replayed and possibly answered twice
+            await set_status(job_id, 'failed')
+            raise
+        await complete(job_id, tg_id, outcome)
+    finally:
+        _in_flight.discard(task)
+
+# Tasks currently inside run(), waited for on shutdown
+_in_flight = set()
+
+
+# --- Replay after a restart ---
+
+async def _send_text(bot: Bot, chat_id, text):
+    while text:
+        split = split_point(text, TELEGRAM_MESSAGE_LIMIT) if len(text) > TELEGRAM_MESSAGE_LIMIT else len(text)
+        await bot.send_message(chat_id, text[:split])
+        text = text[split:]
+
+def _replay_work(bot: Bot, row: GenerationJob, payload: dict):
+    """
+    Builds the work for a job that never answered; it replies with plain messages since the
+    original Message object is gone.
+    """
+    async def text():
+        started = time.monotonic()
+        response = await gemini(payload["prompt"])
+        await _send_text(bot, row.chat_id, response)
+        if response in TEXT_ERROR_REPLIES:
+            return None
+        return JobOutcome(GEMINI_FLASH_MODEL, len(payload["prompt"]), started, response)
+
+    async def image():
+        started = time.monotonic()
+        result = await handle_generate_image(payload["prompt"], bot)
+        if isinstance(result, BufferedInputFile):
+            await bot.send_photo(row.chat_id, photo=result)
+            return JobOutcome(IMAGEN_3_MODEL, 1, started)
+        await bot.send_message(row.chat_id, result)
+        return None
+
+    async def tts():
+        started = time.monotonic()
+        audio_file = await handle_generate_speech(payload["text"], payload["voice"], bot)
+        if audio_file:
+            await bot.send_voice(row.chat_id, voice=audio_file)
+            return JobOutcome(TTS_MODEL, len(payload["text"]), started)
+        await bot.send_message(row.chat_id, "Sorry, I couldn't generate the speech.")
+        return None
+
+    async def vision():
+        started = time.monotonic()
+        photo = PhotoSize.model_validate(payload["photo"])
+        analysis = await handle_analyze_image(photo, bot, question=payload.get("caption"))
+        if analysis:
+            await _send_text(bot, row.chat_id, analysis)
+            return JobOutcome(GEMINI_FLASH_MODEL, 1, started, analysis)
+        await bot.send_message(row.chat_id, "Sorry, I couldn't analyze that image.")
+        return None
+
+    return {"text": text, "image": image, "tts": tts, "vision": vision}[row.kind]
+
+async def _claim(job_id, cutoff) -> bool:
+    """
+    Takes a job for replay. Only one process can win, and only once the job sat untouched since `cutoff`.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            update(GenerationJob)
+            .where(GenerationJob.id == job_id, GenerationJob.status.in_(['pending', 'replaying']),
+                   GenerationJob.updated_at <= cutoff)
+            .values(status='replaying', attempts=GenerationJob.attempts + 1)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+async def _replay(bot: Bot, row: GenerationJob, delay=0.0):
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if not await _claim(row.id, datetime.now() - timedelta(seconds=JOB_REPLAY_AFTER)):
+        # Finished or taken over by another process meanwhile
+        return
+    if row.attempts >= JOB_MAX_ATTEMPTS:
+        log.error(f"Job {row.id} failed {row.attempts} times, giving up.")
+        await set_status(row.id, 'failed')
+        return
+    log.info(f"Replaying {row.kind} job {row.id} for user {row.tg_id}.")
+    await run(row.id, row.tg_id, row.kind, _replay_work(bot, row, json.loads(row.payload)))
+
+async def replay_jobs(bot: Bot):
+    """
+    Picks up jobs left unfinished by the previous run: answered ones are only billed,
+    pending ones are generated and answered again, up to JOB_MAX_ATTEMPTS times.
+    Jobs touched less than JOB_REPLAY_AFTER seconds ago are retried once they are old enough.
+    """
+    async with async_session() as session:
+        rows = (await session.scalars(
+            select(GenerationJob).where(GenerationJob.status.in_(['pending', 'replaying', 'answered']))
+            .order_by(GenerationJob.id)
+        )).all()
+
+    now = datetime.now()
+    for row in rows:
+        if row.status == 'answered':
+            # The ledger skips jobs another process has already billed
+            result = json.loads(row.result)
+            await ledger.record(row.tg_id, result["model"], result["units"], result["latency"], job_id=row.id)
+            continue
+        delay = (row.updated_at + timedelta(seconds=JOB_REPLAY_AFTER) - now).total_seconds()
+        task = asyncio.create_task(_replay(bot, row, delay))
+        _replays.add(task)
+        task.add_done_callback(_replays.discard)
+
+# Keep references to replay tasks so they aren't garbage collected
+_replays = set()
+
+async def drain_jobs():
+    """
+    Gives running jobs up to SHUTDOWN_DRAIN_TIMEOUT seconds to finish on shutdown.
+    Whatever is left stays pending in the database and is replayed on the next start.
+    """
+    tasks = [task for task in _in_flight if task is not asyncio.current_task()]
+    if not tasks:
+        return
+    log.info(f"Waiting up to {SHUTDOWN_DRAIN_TIMEOUT}s for {len(tasks)} running jobs...")
+    done, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    if pending:
+        log.warning(f"{len(pending)} jobs did not finish in time and will be replayed on the next start.")
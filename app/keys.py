@@ -0,0 +1,192 @@
+import datetime
+import logging
+import time
+from zoneinfo import ZoneInfo
+
+import config
+
+# --- API key pool settings (override any of them in config.py) ---
+# Requests per key per day for the whole bot; None means the quota is unknown and not tracked
+KEY_DAILY_QUOTA = getattr(config, "GEMINI_KEY_DAILY_QUOTA", None)
+# Gemini daily quotas reset at midnight Pacific time
+KEY_QUOTA_TIMEZONE = getattr(config, "GEMINI_KEY_QUOTA_TIMEZONE", "America/Los_Angeles")
+# A throttled key sits out for Retry-After, or this long doubled per consecutive 429, up to the maximum
+KEY_QUARANTINE = getattr(config, "GEMINI_KEY_QUARANTINE", 10.0)
+KEY_MAX_QUARANTINE = getattr(config, "GEMINI_KEY_MAX_QUARANTINE", 300.0)
+# Keys rejected as invalid (401/403) are benched for much longer
+KEY_INVALID_QUARANTINE = getattr(config, "GEMINI_KEY_INVALID_QUARANTINE", 3600.0)
+
+KEY_HEADER = "x-goog-api-key"
+
+log = logging.getLogger(__name__)
+
+
+def load_keys() -> list:
+    """
+    Reads the Gemini API keys from config: an AITOKENS list, or AITOKEN holding one key
+    or several separated by commas.
+    """
+    keys = getattr(config, "AITOKENS", None) or getattr(config, "AITOKEN", "") or []
+    if isinstance(keys, str):
+        keys = keys.split(",")
+    unique = []
+    for key in keys:
+        key = key.strip()
+        if key and key not in unique:
+            unique.append(key)
+    return unique
+
+
+class ApiKey:
+    """
+    One API key and its usage: requests in flight, today's count and quarantine state.
+    """
+
+    def __init__(self, value: str):
+        self.value = value
+        self.label = f"...{value[-4:]}"
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.used_today = 0
+        self.strikes = 0
+        self.quarantined_until = 0.0
+        self.last_used = 0.0
+
+    @property
+    def headers(self) -> dict:
+        return {KEY_HEADER: self.value}
+
+    def quarantined(self, now=None) -> bool:
+        return (now or time.monotonic()) < self.quarantined_until
+
+    def remaining(self, quota=KEY_DAILY_QUOTA):
+        return None if quota is None else max(0, quota - self.used_today)
+
+
+class KeyPool:
+    """
+    Spreads Gemini requests over several API keys, each with its own quota.
+    Every request takes the least loaded healthy key; keys that get 429s are quarantined
+    for a while, and keys that used up their daily quota wait for the reset.
+    """
+
+    def __init__(self, keys, daily_quota=KEY_DAILY_QUOTA, quarantine=KEY_QUARANTINE,
+                 max_quarantine=KEY_MAX_QUARANTINE, invalid_quarantine=KEY_INVALID_QUARANTINE,
+                 timezone=KEY_QUOTA_TIMEZONE):
+        self.keys = [ApiKey(key) for key in keys]
+        self.daily_quota = daily_quota
+        self.quarantine = quarantine
+        self.max_quarantine = max_quarantine
+        self.invalid_quarantine = invalid_quarantine
+        self.timezone = _timezone(timezone)
+        self.day = self._today()
+        self.failovers = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _today(self):
+        return datetime.datetime.now(self.timezone).date()
+
+    def _roll_day(self):
+        today = self._today()
+        if today != self.day:
+            self.day = today
+            for key in self.keys:
+                key.used_today = 0
+
+    def _healthy(self, key: ApiKey, now: float) -> bool:
+        return not key.quarantined(now) and key.remaining(self.daily_quota) != 0
+
+    def has_healthy(self) -> bool:
+        self._roll_day()
+        now = time.monotonic()
+        return any(self._healthy(key, now) for key in self.keys)
+
+    def acquire(self) -> ApiKey:
+        """
+        Picks a key for one request and marks it busy. When every key is throttled or out of quota
+        the one that frees up first is used anyway, so the limiter's backoff decides what happens next.
+        """
+        if not self.keys:
+            raise RuntimeError("No Gemini API keys configured (set AITOKEN or AITOKENS in config.py).")
+        self._roll_day()
+        now = time.monotonic()
+        healthy = [key for key in self.keys if self._healthy(key, now)]
+        if healthy:
+            key = min(healthy, key=lambda key: (key.in_flight, key.used_today, key.last_used))
+        else:
+            key = min(self.keys, key=lambda key: key.quarantined_until)
+        key.in_flight += 1
+        key.requests += 1
+        key.used_today += 1
+        key.last_used = now
+        return key
+
+    def release(self, key: ApiKey, status=None, retry_after=None):
+        """
+        Returns a key after its request, quarantining it if the API throttled or rejected it.
+        `status` is None when no response arrived.
+        """
+        key.in_flight -= 1
+        if status == 429:
+            key.throttled += 1
+            key.strikes += 1
+            seconds = retry_after if retry_after is not None else min(
+                self.max_quarantine, self.quarantine * 2 ** (key.strikes - 1))
+            self._bench(key, seconds)
+            log.warning(f"Gemini key {key.label} throttled, quarantined for {seconds:.0f}s.")
+        elif status in (401, 403):
+            self._bench(key, self.invalid_quarantine)
+            log.error(f"Gemini key {key.label} was rejected ({status}), quarantined for {self.invalid_quarantine:.0f}s.")
+        elif status is not None and status < 500:
+            key.strikes = 0
+
+    def _bench(self, key: ApiKey, seconds: float):
+        key.quarantined_until = max(key.quarantined_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "in_flight": {key.label: key.in_flight for key in self.keys},
+            "requests": {key.label: key.requests for key in self.keys},
+            "throttled": {key.label: key.throttled for key in self.keys},
+            "quarantined": {key.label: int(key.quarantined(now)) for key in self.keys},
+            "remaining": {key.label: key.remaining(self.daily_quota) for key in self.keys
+                          if self.daily_quota is not None},
+            "failovers": self.failovers,
+        }
+
+
+def _timezone(name):
+    if name:
+        try:
+            return ZoneInfo(name)
+        except Exception:
+            log.warning(f"Unknown time zone {name}, counting key quotas in UTC.")
+    return datetime.timezone.utc
+
+
+_pool = None
+# Number of processes sharing the keys' daily quotas (see set_process_share)
+_share = 1
+
+def set_process_share(processes: int):
+    """
+    Gives this process an even share of each key's daily quota when `processes` processes use the same keys.
+    Call before the first get_key_pool().
+    """
+    global _share
+    _share = max(1, processes)
+
+def get_key_pool() -> KeyPool:
+    """
+    Returns the process-wide API key pool.
+    """
+    global _pool
+    if _pool is None:
+        quota = KEY_DAILY_QUOTA if KEY_DAILY_QUOTA is None else max(1, KEY_DAILY_QUOTA // _share)
+        _pool = KeyPool(load_keys(), daily_quota=quota)
+        log.info(f"Loaded {len(_pool)} Gemini API key(s).")
+    return _pool
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Status codes worth retrying; everything else is handed back to the caller as-is
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# --- Per-endpoint defaults (override with a GEMINI_LIMITS dict in config.py) ---
+# The limits are for the whole bot: the workers mode splits them between its processes. Separate
+# webhook processes each apply them in full, so divide them yourself when running several
+DEFAULT_LIMITS = {
+    "text": {"rate": 10.0, "burst": 20, "max_concurrency": 32},
+    "text_fallback": {"rate": 10.0, "burst": 20, "max_concurrency": 32},
+    "vision": {"rate": 5.0, "burst": 10, "max_concurrency": 16},
+    "imagen": {"rate": 1.0, "burst": 5, "max_concurrency": 4},
+    "tts": {"rate": 3.0, "burst": 6, "max_concurrency": 8},
+}
+
+
+class RateLimitError(Exception):
+    """
+    Raised when a request could not be completed within its retry budget.
+    """
+
+
+class CircuitOpenError(RateLimitError):
+    """
+    Raised immediately while the endpoint's circuit breaker is open.
+    """
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `burst` stored.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and fails fast for `recovery_time` seconds.
+    After that a single probe request is let through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, recovery_time=30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.recovery_time:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def record_abandoned(self):
+        # A cancelled request tells nothing about the endpoint; let the next one probe instead
+        self.probing = False
+
+
+class EndpointLimiter:
+    """
+    Process-wide gate in front of one upstream endpoint.
+    Combines a token bucket, AIMD adaptive concurrency, jittered backoff that honors Retry-After,
+    a circuit breaker and a cap on the total time a single request may spend retrying.
+    """
+
+    def __init__(self, name, rate=5.0, burst=10, max_concurrency=16, min_concurrency=1,
+                 latency_target=20.0, max_retries=6, base_delay=1.0, max_delay=30.0,
+                 retry_budget=90.0, failure_threshold=5, recovery_time=30.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, recovery_time)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    # --- Adaptive concurrency (AIMD) ---
+
+    async def _enter(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < max(self.min_concurrency, int(self.concurrency)))
+            self.in_flight += 1
+
+    async def _exit(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _increase(self):
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / max(self.concurrency, 1))
+
+    def _decrease(self):
+        # Only back off once per latency window so a burst of 429s doesn't collapse the limit to the floor
+        now = time.monotonic()
+        if now - self._last_decrease < self.latency_target:
+            return
+        self._last_decrease = now
+        self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+        log.warning(f"[{self.name}] Concurrency limit lowered to {self.concurrency:.1f}.")
+
+    # --- Backoff helpers ---
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _pause(self, seconds):
+        # Every caller of this endpoint waits out a server-requested pause, not just the one that got the 429
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def call(self, api_call):
+        """
+        Runs `api_call` (a coroutine function returning an aiohttp response) under the limiter.
+        Returns the first non-retryable response; raises RateLimitError when retries run out.
+        """
+        deadline = time.monotonic() + self.retry_budget
+        last_error = None
+        for attempt in range(self.max_retries):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"{self.name} endpoint is unavailable, circuit is open.")
+
+            # A half-open breaker just let this request through as its probe; any way out of this
+            # attempt that doesn't record an outcome must hand the probe back
+            try:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    if time.monotonic() + pause > deadline:
+                        self.breaker.record_abandoned()
+                        break
+                    await asyncio.sleep(pause)
+                await self.bucket.acquire()
+                await self._enter()
+            except BaseException:
+                self.breaker.record_abandoned()
+                raise
+
+            retry_after = None
+            started = time.monotonic()
+            try:
+                response = await api_call()
+            except Exception as e:
+                log.error(f"[{self.name}] API call failed with error: {e}")
+                last_error = e
+                self.breaker.record_failure()
+                self._decrease()
+            except BaseException:
+                self.breaker.record_abandoned()
+                raise
+            else:
+                latency = time.monotonic() - started
+                if response.status not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    if latency > self.latency_target:
+                        self._decrease()
+                    else:
+                        self._increase()
+                    return response
+
+                last_error = RateLimitError(f"{self.name} endpoint returned {response.status}")
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                response.release()
+                if response.status == 429:
+                    self.breaker.record_success()
+                    if retry_after is not None:
+                        self._pause(retry_after)
+                else:
+                    self.breaker.record_failure()
+                self._decrease()
+            finally:
+                await self._exit()
+
+            if attempt == self.max_retries - 1:
+                break
+            delay = self._backoff(attempt, retry_after)
+            if time.monotonic() + delay > deadline:
+                break
+            log.warning(f"[{self.name}] {last_error}. Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+        raise RateLimitError(f"{self.name} API call failed after retries: {last_error}")
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header given either in seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_limiters = {}
+# Number of processes sharing the configured limits (see set_process_share)
+_share = 1
+
+def set_process_share(processes: int):
+    """
+    Splits the configured rate, burst and concurrency evenly between `processes` processes that call
+    the API with the same keys, e.g. the workers of the "workers" run mode. Call before the first get_limiter().
+    """
+    global _share
+    _share = max(1, processes)
+
+def get_limiter(name: str) -> EndpointLimiter:
+    """
+    Returns the shared limiter for an endpoint ("text", "text_fallback", "vision", "imagen" or "tts").
+    """
+    if name not in _limiters:
+        settings = dict(DEFAULT_LIMITS.get(name, {}))
+        settings.update(getattr(config, "GEMINI_LIMITS", {}).get(name, {}))
+        if _share > 1:
+            for key in ("rate", "burst", "max_concurrency"):
+                if key in settings:
+                    settings[key] = settings[key] / _share if key == "rate" else max(1, settings[key] // _share)
+        _limiters[name] = EndpointLimiter(name, **settings)
+    return _limiters[name]
@@ -0,0 +1,152 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import re
+
+import config
+from app.keys import load_keys
+
+# --- Logging settings (override any of them in config.py) ---
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+LOG_FILE = getattr(config, "LOG_FILE", "bot.log")
+LOG_FORMAT = getattr(config, "LOG_FORMAT", "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+# Rotate bot.log at this size and keep this many old files
+LOG_MAX_BYTES = getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024)
+LOG_BACKUP_COUNT = getattr(config, "LOG_BACKUP_COUNT", 5)
+# Longer messages are cut; records beyond the queue size are dropped instead of blocking the event loop
+LOG_MAX_MESSAGE = getattr(config, "LOG_MAX_MESSAGE", 2000)
+LOG_QUEUE_SIZE = getattr(config, "LOG_QUEUE_SIZE", 10000)
+# Fraction of DEBUG lines kept, and per-logger fractions of lines below WARNING
+LOG_DEBUG_SAMPLE_RATE = getattr(config, "LOG_DEBUG_SAMPLE_RATE", 0.1)
+LOG_SAMPLE_RATES = getattr(config, "LOG_SAMPLE_RATES", {"aiohttp.access": 0.1})
+
+# API keys in query strings and headers, and long base64 runs (inline audio and images)
+KEY_PATTERN = re.compile(r"((?:[?&]key=|x-goog-api-key['\"]?\s*[:=]\s*['\"]?))[\w\-.]+", re.IGNORECASE)
+BASE64_PATTERN = re.compile(r"[A-Za-z0-9+/]{256,}={0,2}")
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every N records below WARNING for noisy call sites, counted per logging call site.
+    """
+
+    def __init__(self, debug_rate=LOG_DEBUG_SAMPLE_RATE, rates=LOG_SAMPLE_RATES):
+        super().__init__()
+        self.debug_rate = debug_rate
+        self.rates = dict(rates)
+        self.counters = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        if rate is None and record.levelno <= logging.DEBUG:
+            rate = self.debug_rate
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        site = (record.name, record.pathname, record.lineno)
+        count = self.counters.get(site, 0)
+        self.counters[site] = count + 1
+        return count % round(1 / rate) == 0
+
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread. Messages are rendered here, with secrets removed
+    and oversized payloads cut, so only short strings cross the queue.
+    When the queue is full the record is dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, log_queue, secrets=(), max_message=LOG_MAX_MESSAGE):
+        super().__init__(log_queue)
+        self.secrets = [secret for secret in secrets if secret]
+        self.max_message = max_message
+        self.dropped = 0
+
+    def redact(self, message: str) -> str:
+        for secret in self.secrets:
+            message = message.replace(secret, "***")
+        if len(message) > self.max_message:
+            message = f"{message[:self.max_message]}... [{len(message) - self.max_message} chars truncated]"
+        message = KEY_PATTERN.sub(r"\1***", message)
+        return BASE64_PATTERN.sub(lambda match: f"<{len(match.group())} base64 chars>", message)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.msg = self.redact(record.msg)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handlers = []
+# Listeners writing records that other processes send (see forward_logs)
+_forwarders = []
+_configured = False
+
+def setup_logging(level=LOG_LEVEL, log_file=LOG_FILE, log_queue=None):
+    """
+    Configures the root logger once per process: records go through a bounded queue to a
+    background thread that writes the rotating log file and the console.
+    With `log_queue` (a multiprocessing queue another process passes to forward_logs) records are
+    sent there instead, replacing any earlier setup, so several processes share a single writer.
+    """
+    global _listener, _configured
+    if _configured and log_queue is None:
+        return
+    stop_logging()
+
+    if log_queue is None:
+        formatter = logging.Formatter(LOG_FORMAT)
+        _handlers.append(logging.StreamHandler())
+        if log_file:
+            _handlers.append(logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"))
+        for handler in _handlers:
+            handler.setFormatter(formatter)
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(log_queue, *_handlers, respect_handler_level=True)
+        _listener.start()
+
+    queue_handler = RedactingQueueHandler(log_queue, secrets=(*load_keys(), getattr(config, "TOKEN", None)))
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    if not _configured:
+        atexit.register(stop_logging)
+    _configured = True
+
+def forward_logs(log_queue):
+    """
+    Writes the records other processes put on `log_queue` with this process's handlers.
+    Only one process then rotates bot.log, instead of every process rotating it on its own.
+    """
+    listener = logging.handlers.QueueListener(log_queue, *_handlers, respect_handler_level=True)
+    listener.start()
+    _forwarders.append(listener)
+
+def stop_logging():
+    """
+    Writes out everything still queued and stops the listener threads.
+    """
+    global _listener
+    while _forwarders:
+        _forwarders.pop().stop()
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    while _handlers:
+        _handlers.pop().close()
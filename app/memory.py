@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import config
+from app.database.models import async_session, Conversation as ConversationRow
+from app.generators import generate_text
+
+# --- Conversation memory settings (override any of them in config.py) ---
+MEMORY_ENABLED = getattr(config, "MEMORY_ENABLED", True)
+# Estimated tokens of history (summary included) sent with each message; older turns are summarized beyond it
+MEMORY_TOKEN_BUDGET = getattr(config, "MEMORY_TOKEN_BUDGET", 3000)
+MEMORY_SUMMARY_TOKENS = getattr(config, "MEMORY_SUMMARY_TOKENS", 400)
+# Conversations kept in memory, and how long an idle one stays there
+MEMORY_MAX_CONVERSATIONS = getattr(config, "MEMORY_MAX_CONVERSATIONS", 10000)
+MEMORY_IDLE_TTL = getattr(config, "MEMORY_IDLE_TTL", 30 * 60)
+# None keeps conversations in memory only; "sqlite" also stores them in the bot's database
+MEMORY_BACKEND = getattr(config, "MEMORY_BACKEND", None)
+# Stored conversations untouched for this many seconds are deleted
+MEMORY_RETENTION = getattr(config, "MEMORY_RETENTION", 7 * 24 * 3600)
+MEMORY_SWEEP_INTERVAL = getattr(config, "MEMORY_SWEEP_INTERVAL", 60)
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below between a user and an assistant in at most {words} words. "
+    "Keep the names, facts, preferences, decisions and open questions the assistant will need later. "
+    "Answer with the summary only.\n\n{previous}{transcript}"
+)
+
+log = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    # About four characters per token; close enough for a budget without shipping a tokenizer
+    return len(text) // 4 + 1
+
+
+class Conversation:
+    """
+    One user's history: a summary of older turns plus the recent (role, text) turns, oldest first.
+    """
+    __slots__ = ("tg_id", "summary", "turns", "tokens", "last_active", "lock", "compacting", "version")
+
+    def __init__(self, tg_id, summary="", turns=()):
+        self.tg_id = tg_id
+        self.summary = summary
+        self.turns = deque(turns)
+        self.tokens = 0
+        self.last_active = time.monotonic()
+        # Held while a reply is generated, so a user's messages see each other's turns
+        self.lock = asyncio.Lock()
+        self.compacting = False
+        self.version = 0
+        self.recount()
+
+    def recount(self):
+        self.tokens = (estimate_tokens(self.summary) if self.summary else 0) + sum(
+            estimate_tokens(text) for _, text in self.turns)
+
+    def history(self):
+        """
+        Returns (summary, turns) for generators.gemini(), or None when there is nothing to remember.
+        """
+        if not self.summary and not self.turns:
+            return None
+        return self.summary, list(self.turns)
+
+
+class ConversationMemory:
+    """
+    Bounded per-user conversation store.
+    Each conversation is kept under MEMORY_TOKEN_BUDGET: once a reply pushes it over, the oldest turns are
+    summarized in the background and replaced by the summary. Idle conversations leave memory after
+    MEMORY_IDLE_TTL; with the sqlite backend they are written through to the database and loaded back
+    on the user's next message.
+    """
+
+    def __init__(self, budget=MEMORY_TOKEN_BUDGET, max_conversations=MEMORY_MAX_CONVERSATIONS,
+                 idle_ttl=MEMORY_IDLE_TTL, backend=MEMORY_BACKEND, retention=MEMORY_RETENTION):
+        self.budget = budget
+        self.max_conversations = max_conversations
+        self.idle_ttl = idle_ttl
+        self.persistent = backend == "sqlite"
+        self.retention = retention
+        self.conversations = OrderedDict()
+        self.compactions = 0
+        self.evictions = 0
+        self.dropped_turns = 0
+        self._tasks = set()
+        self._sweeper = None
+
+    async def get(self, tg_id) -> Conversation:
+        """
+        Returns the user's conversation, loading it from the database or starting a new one.
+        """
+        conversation = self.conversations.get(tg_id)
+        if conversation is not None:
+            self.conversations.move_to_end(tg_id)
+            return conversation
+
+        conversation = await self._load(tg_id) if self.persistent else None
+        # Another message of the same user may have loaded it meanwhile
+        if tg_id in self.conversations:
+            return self.conversations[tg_id]
+        conversation = conversation or Conversation(tg_id)
+        self.conversations[tg_id] = conversation
+        while len(self.conversations) > self.max_conversations:
+            self.conversations.popitem(last=False)
+            self.evictions += 1
+        return conversation
+
+    async def add_turn(self, conversation: Conversation, prompt: str, answer: str):
+        """
+        Appends a question and its answer, then keeps the conversation within its budget.
+        """
+        if self.conversations.get(conversation.tg_id) is not conversation:
+            # Reset (or evicted) while the answer was being generated
+            return
+        conversation.turns.append(("user", prompt))
+        conversation.turns.append(("model", answer))
+        conversation.tokens += estimate_tokens(prompt) + estimate_tokens(answer)
+        conversation.last_active = time.monotonic()
+
+        # Hard limit while a summary is still being written (or keeps failing): drop the oldest exchange
+        while conversation.tokens > 2 * self.budget and len(conversation.turns) > 2:
+            for _ in range(2):
+                _, text = conversation.turns.popleft()
+                conversation.tokens -= estimate_tokens(text)
+                self.dropped_turns += 1
+
+        if conversation.tokens > self.budget and not conversation.compacting:
+            conversation.compacting = True
+            task = asyncio.create_task(self._compact(conversation))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        await self._save(conversation)
+
+    async def reset(self, tg_id):
+        """
+        Forgets everything about the user's conversation.
+        """
+        conversation = self.conversations.pop(tg_id, None)
+        if conversation is not None:
+            conversation.version += 1
+        if self.persistent:
+            async with async_session() as session:
+                await session.execute(delete(ConversationRow).where(ConversationRow.tg_id == tg_id))
+                await session.commit()
+
+    # --- Compaction ---
+
+    async def _compact(self, conversation: Conversation):
+        try:
+            # Summarize the oldest whole exchanges until about half the budget is left for recent turns
+            old, remaining = [], conversation.tokens
+            for turn in list(conversation.turns)[:-2]:
+                role, text = turn
+                if remaining <= self.budget // 2 and role == "user":
+                    break
+                old.append(turn)
+                remaining -= estimate_tokens(text)
+            if len(old) % 2:
+                old.pop()
+            if not old:
+                return
+            version = conversation.version
+
+            summary = await self._summarize(conversation.summary, old)
+            if conversation.version != version:
+                return
+            # Turns may already have been dropped by the hard limit; remove whatever of `old` is still there
+            while conversation.turns and any(conversation.turns[0] is turn for turn in old):
+                conversation.turns.popleft()
+            if summary:
+                # Models overshoot word limits; cap at about twice the summary budget
+                conversation.summary = summary[:MEMORY_SUMMARY_TOKENS * 8]
+            else:
+                self.dropped_turns += len(old)
+            conversation.recount()
+            self.compactions += 1
+            log.debug(f"Compacted conversation of {conversation.tg_id} to ~{conversation.tokens} tokens.")
+            await self._save(conversation)
+        except Exception as e:
+            log.error(f"Failed to compact conversation of {conversation.tg_id}: {e}")
+        finally:
+            conversation.compacting = False
+
+    async def _summarize(self, previous: str, turns) -> str:
+        transcript = "\n".join(f"{'User' if role == 'user' else 'Assistant'}: {text}" for role, text in turns)
+        prompt = SUMMARY_PROMPT.format(
+            words=MEMORY_SUMMARY_TOKENS * 3 // 4,
+            previous=f"Summary so far: {previous}\n\n" if previous else "",
+            transcript=transcript,
+        )
+        try:
+            return (await generate_text(prompt, use_cache=False)).strip()
+        except Exception as e:
+            # The turns are dropped without a summary; the budget matters more than perfect recall
+            log.warning(f"Could not summarize conversation, dropping {len(turns)} turns: {e}")
+            return None
+
+    # --- Persistence ---
+
+    async def _load(self, tg_id):
+        async with async_session() as session:
+            row = await session.scalar(select(ConversationRow).where(ConversationRow.tg_id == tg_id))
+        if row is None or row.updated_at < datetime.now() - timedelta(seconds=self.retention):
+            return None
+        return Conversation(tg_id, row.summary or "", [tuple(turn) for turn in json.loads(row.turns or "[]")])
+
+    async def _save(self, conversation: Conversation):
+        if not self.persistent:
+            return
+        values = {"summary": conversation.summary, "turns": json.dumps(list(conversation.turns), ensure_ascii=False),
+                  "updated_at": datetime.now()}
+        statement = sqlite_insert(ConversationRow).values(tg_id=conversation.tg_id, **values)
+        try:
+            async with async_session() as session:
+                await session.execute(statement.on_conflict_do_update(index_elements=[ConversationRow.tg_id], set_=values))
+                await session.commit()
+        except Exception as e:
+            log.error(f"Failed to store conversation of {conversation.tg_id}: {e}")
+
+    # --- Idle eviction ---
+
+    async def sweep(self):
+        """
+        Drops idle conversations from memory and deletes stored ones past their retention.
+        """
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [tg_id for tg_id, conversation in self.conversations.items()
+                if conversation.last_active < cutoff and not conversation.lock.locked() and not conversation.compacting]
+        for tg_id in idle:
+            del self.conversations[tg_id]
+        self.evictions += len(idle)
+        if self.persistent:
+            async with async_session() as session:
+                await session.execute(delete(ConversationRow).where(
+                    ConversationRow.updated_at < datetime.now() - timedelta(seconds=self.retention)))
+                await session.commit()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(MEMORY_SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                log.error(f"Conversation memory sweep failed: {e}")
+
+    async def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [task for task in (self._sweeper, *self._tasks) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sweeper = None
+
+    def stats(self) -> dict:
+        return {
+            "conversations": len(self.conversations),
+            "tokens": sum(conversation.tokens for conversation in self.conversations.values()),
+            "compactions": self.compactions,
+            "evictions": self.evictions,
+            "dropped_turns": self.dropped_turns,
+        }
+
+
+memory = ConversationMemory()
@@ -0,0 +1,279 @@
+import bisect
+import contextvars
+import logging
+import secrets
+
+from aiohttp import web
+
+import config
+
+# --- Metrics settings (override any of them in config.py) ---
+# Local port serving /metrics in Prometheus text format; None disables the endpoint
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9100)
+# Prefix every log line written while handling an update with that update's trace id
+TRACE_IDS = getattr(config, "TRACE_IDS", True)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+log = logging.getLogger(__name__)
+
+
+# --- Metric types ---
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """
+    Base of the metric types: a name, a help text and label names, with one value per label combination.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra=()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, self._labels(key), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {value}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With `collect`, values are read from a callback
+    returning {label tuple: value} each time the metrics are scraped.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), collect=None, kind=None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+        if kind:
+            self.kind = kind
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.collect is not None:
+            try:
+                self.values = {tuple(map(str, key)): value for key, value in self.collect().items()}
+            except Exception as e:
+                log.error(f"Failed to collect {self.name}: {e}")
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Per-bucket counts (the last one is +Inf), then the sum of observed values
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", self._labels(key, [("le", bound)]), cumulative
+            yield f"{self.name}_sum", self._labels(key), total
+            yield f"{self.name}_count", self._labels(key), cumulative
+
+
+REGISTRY = []
+
+def render() -> str:
+    """
+    Returns every registered metric in Prometheus text exposition format.
+    """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# --- Hot-path metrics ---
+
+UPDATES = Counter("bot_updates_total", "Updates received from Telegram.", ["type"])
+UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Time from receiving an update to finishing all its handlers.", ["type"])
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Time spent in each message handler, including queueing and generation.", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised an exception.", ["handler"])
+
+UPSTREAM_LATENCY = Histogram("gemini_request_duration_seconds", "Latency of single Gemini API attempts.", ["endpoint"])
+UPSTREAM_RESPONSES = Counter("gemini_responses_total", "Gemini API attempts by HTTP status (\"error\" when no response arrived).", ["endpoint", "status"])
+UPSTREAM_RETRIES = Counter("gemini_retries_total", "Gemini API attempts made after the first one of a call.", ["endpoint"])
+TEXT_HEDGES = Counter("gemini_text_hedges_total", "Extra text requests started: a duplicate (\"hedge\") or the fallback model.", ["kind"])
+TEXT_WINNERS = Counter("gemini_text_winners_total", "Which request produced the text answer.", ["kind"])
+TEXT_CANCELLED = Counter("gemini_text_cancelled_total", "Text requests cancelled because another one answered first.", ["kind"])
+TEXT_DEADLINE_EXCEEDED = Counter("gemini_text_deadline_exceeded_total", "Text requests that got no answer within TEXT_DEADLINE.", ["endpoint"])
+PAYLOAD_BYTES = Histogram("gemini_payload_bytes", "Size of the prompt or image sent and of the response received.", ["endpoint", "direction"], buckets=SIZE_BUCKETS)
+
+TELEGRAM_LATENCY = Histogram("telegram_request_duration_seconds", "Latency of Bot API calls, uploads included.", ["method"])
+TELEGRAM_DOWNLOAD = Histogram("telegram_download_duration_seconds", "Time spent downloading files from Telegram.")
+
+
+# Collected lazily at scrape time so this module imports nothing from the rest of the app
+
+def _cache_counters(field):
+    def collect():
+        from app.cache import get_cache
+        return {(endpoint,): values[field] for endpoint, values in get_cache().stats()["endpoints"].items()}
+    return collect
+
+def _scheduler_stat(field):
+    def collect():
+        from app.scheduler import get_scheduler
+        return {(kind,): value for kind, value in get_scheduler().stats()[field].items()}
+    return collect
+
+def _user_cache_stat(field):
+    def collect():
+        from app.database.user_cache import user_cache
+        return {(): user_cache.stats()[field]}
+    return collect
+
+def _image_stat(field):
+    def collect():
+        from app.imaging import stats
+        return {(): stats[field]}
+    return collect
+
+def _key_stat(field):
+    def collect():
+        from app.keys import get_key_pool
+        return {(label,): value for label, value in get_key_pool().stats()[field].items()}
+    return collect
+
+def _key_failovers():
+    from app.keys import get_key_pool
+    return {(): get_key_pool().failovers}
+
+def _memory_stat(field):
+    def collect():
+        from app.memory import memory
+        return {(): memory.stats()[field]}
+    return collect
+
+def _coalesced():
+    from app.singleflight import get_singleflight
+    return {(): get_singleflight().coalesced}
+
+Gauge("bot_cache_hits_total", "Response cache hits.", ["endpoint"], collect=_cache_counters("hits"), kind="counter")
+Gauge("bot_cache_misses_total", "Response cache misses.", ["endpoint"], collect=_cache_counters("misses"), kind="counter")
+Gauge("bot_user_cache_hits_total", "Known-user cache hits.", collect=_user_cache_stat("hits"), kind="counter")
+Gauge("bot_user_cache_misses_total", "Known-user cache misses.", collect=_user_cache_stat("misses"), kind="counter")
+Gauge("bot_coalesced_requests_total", "Requests that shared an identical in-flight upstream call.", collect=_coalesced, kind="counter")
+Gauge("bot_images_encoded_total", "Generated images re-encoded before upload.", collect=_image_stat("images"), kind="counter")
+Gauge("bot_image_encode_seconds_total", "Time spent re-encoding generated images.", collect=_image_stat("encode_seconds"), kind="counter")
+Gauge("bot_image_original_bytes_total", "Size of generated images before re-encoding.", collect=_image_stat("original_bytes"), kind="counter")
+Gauge("bot_image_encoded_bytes_total", "Size of generated images after re-encoding.", collect=_image_stat("encoded_bytes"), kind="counter")
+Gauge("gemini_key_requests_total", "Gemini API attempts made with each key.", ["key"], collect=_key_stat("requests"), kind="counter")
+Gauge("gemini_key_throttled_total", "429 responses received per key.", ["key"], collect=_key_stat("throttled"), kind="counter")
+Gauge("gemini_key_in_flight", "Gemini requests currently using each key.", ["key"], collect=_key_stat("in_flight"))
+Gauge("gemini_key_quarantined", "1 while a key is sitting out after a 429 or a rejection.", ["key"], collect=_key_stat("quarantined"))
+Gauge("gemini_key_quota_remaining", "Requests left in each key's daily quota (with GEMINI_KEY_DAILY_QUOTA set).", ["key"], collect=_key_stat("remaining"))
+Gauge("gemini_key_failovers_total", "Requests moved to another key after a 429.", collect=_key_failovers, kind="counter")
+Gauge("bot_conversations", "Conversations held in memory.", collect=_memory_stat("conversations"))
+Gauge("bot_conversation_tokens", "Estimated tokens of history held in memory.", collect=_memory_stat("tokens"))
+Gauge("bot_conversation_compactions_total", "Times old turns were folded into a summary.", collect=_memory_stat("compactions"), kind="counter")
+Gauge("bot_conversation_evictions_total", "Conversations dropped from memory as idle or least recently used.", collect=_memory_stat("evictions"), kind="counter")
+Gauge("bot_conversation_dropped_turns_total", "Turns dropped without a summary to stay within the budget.", collect=_memory_stat("dropped_turns"), kind="counter")
+Gauge("bot_queue_depth", "Generation jobs waiting for a worker slot.", ["kind"], collect=_scheduler_stat("queued"))
+Gauge("bot_jobs_running", "Generation jobs currently running.", ["kind"], collect=_scheduler_stat("running"))
+
+
+# --- Trace ids ---
+
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+def new_trace_id() -> str:
+    value = secrets.token_hex(6)
+    trace_id.set(value)
+    return value
+
+def _install_trace_ids():
+    # Tasks started while handling an update copy its context, so scheduled jobs keep the id
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        current = trace_id.get()
+        record.trace_id = current
+        if current is not None:
+            record.msg = f"[{current}] {record.msg}"
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+if TRACE_IDS:
+    _install_trace_ids()
+
+
+# --- /metrics endpoint ---
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+_runner = None
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serves /metrics on a local port for Prometheus to scrape.
+    When the port is taken (e.g. by another bot process on the host) the bot runs without it.
+    """
+    global _runner
+    if port is None or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Several webhook processes on one host all try the same port; the first one serves /metrics
+        await runner.cleanup()
+        log.warning(f"Metrics server not started on {host}:{port}: {e}")
+        return
+    _runner = runner
+    log.info(f"Metrics available at http://{host}:{port}/metrics")
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,85 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+from app.database.requests import get_known_user
+from app.metrics import (new_trace_id, UPDATES, UPDATE_LATENCY, HANDLER_LATENCY, HANDLER_ERRORS,
+                         TELEGRAM_LATENCY)
+
+
+class KnownUserMiddleware(BaseMiddleware):
+    """
+    Registers the sender of every update and passes it to handlers as `known_user` (a CachedUser).
+    Users seen recently come from the in-process cache without a database round-trip.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        if from_user is not None and not from_user.is_bot:
+            data["known_user"] = await get_known_user(from_user.id)
+        return await handler(event, data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: gives every update a trace id for the logs and records how long it took.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        new_trace_id()
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        UPDATES.inc(type=update_type)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_LATENCY.observe(time.perf_counter() - started, type=update_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware: records the latency and failures of each handler by its function name.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Bot session middleware: records the latency of every Bot API call, so sendPhoto/sendVoice uploads show up too.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=method.__api_method__)
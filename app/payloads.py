@@ -0,0 +1,122 @@
+import binascii
+import json
+import re
+import struct
+
+from aiogram.types import BufferedInputFile
+
+# JSON fields whose string value is a large base64 blob
+BASE64_FIELDS = ("data", "bytesBase64Encoded")
+READ_CHUNK_SIZE = 64 * 1024
+# Size of the canonical PCM WAV header written in front of TTS audio
+WAV_HEADER_SIZE = 44
+
+
+class Base64FieldDecoder:
+    """
+    Incremental scanner for a JSON response that carries one big base64 string.
+    The first matching field is decoded chunk by chunk straight into the output buffer;
+    everything else is kept as a small "skeleton" document with that string left empty.
+    """
+
+    def __init__(self, fields=BASE64_FIELDS, size_hint=None, reserve=0):
+        names = "|".join(re.escape(field) for field in fields)
+        self.pattern = re.compile(rf'"(?:{names})"\s*:\s*"'.encode())
+        # Longest text that can still turn into a match once the next chunk arrives
+        self.carry_limit = max(len(field) for field in fields) + 16
+        self.skeleton = bytearray()
+        self.carry = b""
+        self.pending = b""
+        self.decoding = False
+        self.done = False
+        # Decoded base64 is at most 3/4 of the encoded size, so a known body size lets us allocate once
+        capacity = reserve + (size_hint * 3 // 4 if size_hint else 0)
+        self.output = bytearray(capacity)
+        self.reserve = reserve
+        self.length = reserve
+
+    def feed(self, chunk: bytes):
+        data = self.carry + chunk
+        self.carry = b""
+        while data:
+            if self.decoding:
+                data = self._decode(data)
+                continue
+            match = self.pattern.search(data) if not self.done else None
+            if match is None:
+                keep = 0 if self.done else min(len(data), self.carry_limit)
+                self.skeleton += data[:len(data) - keep]
+                self.carry = data[len(data) - keep:]
+                return
+            self.skeleton += data[:match.end()]
+            self.decoding = True
+            data = data[match.end():]
+
+    def _decode(self, data: bytes) -> bytes:
+        end = data.find(b'"')
+        encoded, rest = (data, b"") if end < 0 else (data[:end], data[end:])
+        # JSON may escape "/" as "\/"
+        encoded = self.pending + encoded.replace(b"\\", b"")
+        usable = len(encoded) - len(encoded) % 4 if end < 0 else len(encoded)
+        self._write(binascii.a2b_base64(encoded[:usable]) if usable else b"")
+        self.pending = encoded[usable:]
+        if end >= 0:
+            self.decoding = False
+            self.done = True
+        return rest
+
+    def _write(self, decoded: bytes):
+        end = self.length + len(decoded)
+        if end <= len(self.output):
+            self.output[self.length:end] = decoded
+        else:
+            del self.output[self.length:]
+            self.output += decoded
+        self.length = end
+
+    def finish(self):
+        """
+        Returns (skeleton document, memoryview of the decoded bytes or None when no field was found).
+        """
+        self.skeleton += self.carry
+        document = json.loads(bytes(self.skeleton)) if self.skeleton.strip() else {}
+        if not self.done:
+            return document, None
+        # Drop whatever the size hint over-allocated without copying the data
+        del self.output[self.length:]
+        return document, memoryview(self.output)
+
+
+async def read_base64_field(response, fields=BASE64_FIELDS, reserve=0):
+    """
+    Reads an aiohttp response once, decoding its base64 field as the body arrives.
+    `reserve` bytes are left free at the start of the buffer (e.g. for a WAV header).
+    """
+    decoder = Base64FieldDecoder(fields, size_hint=response.content_length, reserve=reserve)
+    try:
+        async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+            decoder.feed(chunk)
+    finally:
+        response.release()
+    return decoder.finish()
+
+
+def write_wav_header(buffer: memoryview, data_size: int, sample_rate: int, channels=1, sample_width=2):
+    """
+    Fills the first WAV_HEADER_SIZE bytes of `buffer` with a PCM WAV header for `data_size` bytes of audio.
+    """
+    byte_rate = sample_rate * channels * sample_width
+    struct.pack_into("<4sI4s4sIHHIIHH4sI", buffer, 0, b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1,
+                     channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8, b"data", data_size)
+
+
+class MemoryInputFile(BufferedInputFile):
+    """
+    An upload served straight from a memoryview, without the copy BufferedInputFile makes
+    when it wraps its data in a BytesIO.
+    """
+
+    async def read(self, bot):
+        view = memoryview(self.data)
+        for offset in range(0, len(view), self.chunk_size):
+            yield view[offset:offset + self.chunk_size]
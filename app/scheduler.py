@@ -0,0 +1,191 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict, deque
+
+import config
+
+# --- Scheduler settings (override any of them in config.py) ---
+# Concurrent jobs per pool; pools earlier in the list get free slots first
+POOL_SIZES = {"text": 16, "vision": 4, "tts": 4, "image": 2, **getattr(config, "SCHEDULER_POOL_SIZES", {})}
+PRIORITY = ["text", "vision", "tts", "image"]
+# Total jobs running at once across all pools
+MAX_RUNNING = getattr(config, "SCHEDULER_MAX_RUNNING", 20)
+# Jobs a single user may have running at once
+USER_MAX_RUNNING = getattr(config, "SCHEDULER_USER_MAX_RUNNING", 2)
+
+log = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """
+    Raised to the waiter of a job that was superseded or cancelled before finishing.
+    """
+
+
+class Job:
+    """
+    One unit of generation work submitted to the scheduler.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, scheduler, user_id, kind, factory):
+        self.id = next(self._ids)
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.kind = kind
+        self.factory = factory
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+
+    @property
+    def position(self) -> int:
+        """
+        Estimated number of jobs that will start before this one (0 = next or already running).
+        """
+        return self.scheduler.position(self)
+
+    def cancel(self, reason="cancelled"):
+        self.scheduler.cancel(self, reason)
+
+    async def wait(self):
+        """
+        Waits for the result. Cancelling the waiter cancels the job too.
+        """
+        try:
+            return await asyncio.shield(self.future)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+
+class JobScheduler:
+    """
+    Bounded worker pools for generation work with per-user fairness.
+    Each pool serves its users round-robin, a user can only hold USER_MAX_RUNNING slots,
+    and when global slots are scarce cheaper pools (text) are served before expensive ones (image).
+    """
+
+    def __init__(self, pool_sizes=POOL_SIZES, priority=PRIORITY, max_running=MAX_RUNNING,
+                 user_max_running=USER_MAX_RUNNING):
+        self.pool_sizes = dict(pool_sizes)
+        self.priority = list(priority)
+        self.max_running = max_running
+        self.user_max_running = user_max_running
+        # kind -> user_id -> deque of queued jobs; the dict order is the round-robin order
+        self.queues = {kind: OrderedDict() for kind in self.priority}
+        self.running = {kind: 0 for kind in self.priority}
+        self.running_per_user = {}
+        self.active = {}
+        self.cancelled = 0
+        self.completed = 0
+
+    def submit(self, user_id, kind, factory, supersede=False) -> Job:
+        """
+        Queues `factory()` (a coroutine function) in the pool `kind`.
+        With supersede=True the user's jobs of that kind that haven't started yet are cancelled.
+        """
+        if supersede:
+            for queued in list(self.queues[kind].get(user_id, ())):
+                self.cancel(queued, "superseded")
+        job = Job(self, user_id, kind, factory)
+        self.queues[kind].setdefault(user_id, deque()).append(job)
+        self._dispatch()
+        return job
+
+    def cancel(self, job: Job, reason="cancelled"):
+        if job.future.done():
+            return
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            queue = self.queues[job.kind].get(job.user_id)
+            if queue and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self.queues[job.kind][job.user_id]
+        job.future.set_exception(JobCancelled(reason))
+        # Nobody may be waiting any more; mark the exception as retrieved
+        job.future.exception()
+        self.cancelled += 1
+        log.info(f"Job {job.id} ({job.kind}) for user {job.user_id} {reason}.")
+
+    def position(self, job: Job) -> int:
+        if job.task is not None or job.future.done():
+            return 0
+        users = list(self.queues[job.kind])
+        queue = self.queues[job.kind].get(job.user_id, ())
+        if job not in queue:
+            return 0
+        return queue.index(job) * len(users) + users.index(job.user_id)
+
+    def queue_depth(self) -> dict:
+        return {kind: sum(len(queue) for queue in users.values()) for kind, users in self.queues.items()}
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue_depth(),
+            "running": dict(self.running),
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+        }
+
+    def _dispatch(self):
+        while sum(self.running.values()) < self.max_running:
+            job = self._next_job()
+            if job is None:
+                return
+            self._start(job)
+
+    def _next_job(self):
+        for kind in self.priority:
+            if self.running[kind] >= self.pool_sizes.get(kind, 1):
+                continue
+            users = self.queues[kind]
+            for user_id in list(users):
+                if self.running_per_user.get(user_id, 0) >= self.user_max_running:
+                    continue
+                queue = users.pop(user_id)
+                job = queue.popleft()
+                if queue:
+                    # Back of the line, so every other user gets a turn first
+                    users[user_id] = queue
+                return job
+        return None
+
+    def _start(self, job: Job):
+        self.running[job.kind] += 1
+        self.running_per_user[job.user_id] = self.running_per_user.get(job.user_id, 0) + 1
+        job.task = asyncio.create_task(job.factory())
+        self.active[job.id] = job
+        job.task.add_done_callback(lambda task: self._finish(job, task))
+
+    def _finish(self, job: Job, task: asyncio.Task):
+        self.active.pop(job.id, None)
+        self.running[job.kind] -= 1
+        self.running_per_user[job.user_id] -= 1
+        if not self.running_per_user[job.user_id]:
+            del self.running_per_user[job.user_id]
+        if not job.future.done():
+            if task.cancelled():
+                job.future.set_exception(JobCancelled("cancelled"))
+                job.future.exception()
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+        self.completed += 1
+        self._dispatch()
+
+
+_scheduler = None
+
+def get_scheduler() -> JobScheduler:
+    """
+    Returns the process-wide job scheduler.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+    return _scheduler
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _consume_exception(task: asyncio.Task):
+    # Mark the exception as retrieved even if every waiter went away before the task finished
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into one upstream request.
+    Every caller awaits the same task, so all of them get its result or its exception.
+    The shared task is shielded: cancelling one waiter never cancels it for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self.coalesced = 0
+
+    def in_flight(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    async def do(self, key: str, func):
+        """
+        Runs `func()` (a coroutine function) once per key at a time and returns its result to every caller.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+            task.add_done_callback(_consume_exception)
+        else:
+            self.coalesced += 1
+            log.info(f"Joined in-flight request {key[:12]}.")
+        return await asyncio.shield(task)
+
+    async def do_stream(self, key: str, func):
+        """
+        Streaming counterpart of do(): `func()` returns an async iterator that is consumed once
+        in a background task, and every caller gets the full sequence of items replayed to it.
+        """
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            flight.task = asyncio.ensure_future(flight.pump(func()))
+            self._streams[key] = flight
+            flight.task.add_done_callback(lambda t: self._forget(self._streams, key, flight))
+            flight.task.add_done_callback(_consume_exception)
+        else:
+            self.coalesced += 1
+            log.info(f"Joined in-flight stream {key[:12]}.")
+        async for item in flight.replay():
+            yield item
+
+    @staticmethod
+    def _forget(calls, key, value):
+        if calls.get(key) is value:
+            del calls[key]
+
+
+class _StreamFlight:
+    """
+    Buffers the items of one upstream stream so any number of readers can follow it.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Condition()
+
+    async def pump(self, iterator):
+        try:
+            async for item in iterator:
+                async with self._changed:
+                    self.items.append(item)
+                    self._changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def replay(self):
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.done or len(self.items) > position)
+                pending = self.items[position:]
+                finished = self.done
+            for item in pending:
+                yield item
+            position += len(pending)
+            if finished and position >= len(self.items):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+_singleflight = None
+
+def get_singleflight() -> SingleFlight:
+    """
+    Returns the process-wide request coalescer.
+    """
+    global _singleflight
+    if _singleflight is None:
+        _singleflight = SingleFlight()
+    return _singleflight
@@ -0,0 +1,47 @@
+import json
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.database.models import async_session, FsmState
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage kept in the fsm_states table of the bot's SQLite database.
+    In WAL mode several worker processes can share it, so a chat's state survives
+    being handled by another process or a restart.
+    """
+
+    def __init__(self, key_builder: Optional[KeyBuilder] = None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def _upsert(self, key: StorageKey, **values):
+        statement = sqlite_insert(FsmState).values(key=self.key_builder.build(key), **values)
+        async with async_session() as session:
+            await session.execute(statement.on_conflict_do_update(index_elements=[FsmState.key], set_=values))
+            await session.commit()
+
+    async def _get(self, key: StorageKey) -> Optional[FsmState]:
+        async with async_session() as session:
+            return await session.scalar(select(FsmState).where(FsmState.key == self.key_builder.build(key)))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._upsert(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._get(key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._upsert(key, data=json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._get(key)
+        return json.loads(row.data) if row and row.data else {}
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import config
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Minimum seconds between two edits of the same message
+EDIT_INTERVAL = getattr(config, "STREAM_EDIT_INTERVAL", 1.0)
+
+log = logging.getLogger(__name__)
+
+
+def split_point(text: str, limit: int) -> int:
+    """
+    Finds where to cut an over-long text: the last newline or space before the limit, or the limit itself.
+    """
+    for separator in ('\n', ' '):
+        index = text.rfind(separator, 0, limit)
+        if index > limit // 2:
+            return index + 1
+    return limit
+
+
+class StreamingReply:
+    """
+    A Telegram reply that is edited in place while text keeps arriving.
+    Edits are throttled and the reply rolls over into a new message when it outgrows Telegram's limit.
+    """
+
+    def __init__(self, msg: Message, edit_interval=EDIT_INTERVAL, limit=TELEGRAM_MESSAGE_LIMIT):
+        self.msg = msg
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ""
+        self.sent = None
+        self.shown = ""
+        self.next_edit_at = 0.0
+
+    async def feed(self, chunk: str):
+        """
+        Appends a chunk and updates the message if the throttle allows it.
+        """
+        self.text += chunk
+        while len(self.text) > self.limit:
+            split = split_point(self.text, self.limit)
+            head, self.text = self.text[:split], self.text[split:]
+            await self._flush(head, force=True)
+            self.sent = None
+            self.shown = ""
+        if time.monotonic() >= self.next_edit_at:
+            await self._flush(self.text)
+
+    async def finish(self):
+        """
+        Pushes whatever text is still pending, ignoring the throttle.
+        """
+        await self._flush(self.text, force=True)
+
+    async def _flush(self, text: str, force=False):
+        if not text.strip() or text == self.shown:
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.msg.answer(text)
+            else:
+                await self.sent.edit_text(text)
+        except TelegramRetryAfter as e:
+            if not force:
+                self.next_edit_at = time.monotonic() + e.retry_after
+                return
+            log.warning(f"Telegram asked to slow down edits, waiting {e.retry_after}s.")
+            await asyncio.sleep(e.retry_after)
+            return await self._flush(text, force)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        self.shown = text
+        self.next_edit_at = time.monotonic() + self.edit_interval
@@ -1,24 +1,52 @@
 import logging
+import time
 from aiogram import Router, Bot
 from aiogram.types import Message, BufferedInputFile
 from aiogram.filters import Command
-from app.generators import handle_generate_image, handle_generate_speech, gemini, handle_analyze_image, VOICES
+from app.generators import handle_generate_image, handle_generate_speech, gemini, gemini_stream, handle_analyze_image, VOICES
+from app.generators import pick_photo_size
+from app.generators import GEMINI_FLASH_MODEL, IMAGEN_3_MODEL, TTS_MODEL, TEXT_ERROR_REPLIES
+from app.memory import memory, MEMORY_ENABLED
+from app.streaming import StreamingReply
+from app import jobs
+from app.jobs import JobOutcome
+from app.database.ledger import ledger
 from aiogram.enums import ChatAction
 
+import config
+
 # All handlers should be registered in the router
 user = Router()
 
-# Configure logging to a file and the console
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
 log = logging.getLogger(__name__)
 
+# Stream chat replies token by token instead of waiting for the full answer
+STREAM_RESPONSES = getattr(config, "STREAM_RESPONSES", True)
+# Send the first part of a long /generate_speech as soon as it is ready, then the rest
+TTS_SEND_FIRST_CHUNK = getattr(config, "TTS_SEND_FIRST_CHUNK", False)
+
+async def run_job(msg: Message, kind: str, work, payload: dict, charge, supersede=False):
+    """
+    Records the request as a durable job and runs the handler's generation work through the shared scheduler.
+    `work()` returns a JobOutcome to bill, or None when nothing was generated.
+    `charge` is the (model name, units) the request will cost; nothing runs when the balance can't cover it.
+    A message Telegram delivers again (e.g. after a restart) is recognised and not run twice.
+    """
+    if not await ledger.can_afford(msg.from_user.id, *charge):
+        await msg.answer("Sorry, your balance is too low for this request.")
+        return
+
+    job_id = await jobs.accept(jobs.idempotency_key(msg.chat.id, msg.message_id), kind,
+                               msg.from_user.id, msg.chat.id, payload)
+    if job_id is None:
+        log.info(f"Message {msg.message_id} in chat {msg.chat.id} was already accepted, skipping.")
+        return
+
+    async def on_queued(position):
+        await msg.answer(f"You're number {position + 1} in the queue, I'll reply as soon as possible.")
+
+    await jobs.run(job_id, msg.from_user.id, kind, work, supersede=supersede, on_queued=on_queued)
+
 @user.message(Command("start"))
 async def start_handler(msg: Message):
     """
@@ -29,6 +57,7 @@ async def start_handler(msg: Message):
         "Here are my commands:\n\n"
         "• /generate_image <prompt>\n"
         "• /generate_speech <voice_name> <text>\n"
+        + ("• /new\n" if MEMORY_ENABLED else "") +
         "• /help\n\n"
         "You can also send me a photo with a caption to analyze it. Just send me a photo and type your question in the caption."
     )
@@ -46,11 +75,23 @@ async def help_handler(msg: Message):
         "   You can choose a voice from this list:\n"
         "   " + ", ".join(VOICES) + "\n"
         "   Example: `/generate_speech Kore The quick brown fox jumps over the lazy dog.`\n\n"
+        + ("• /new: Starts a new conversation; I forget what we talked about so far.\n\n" if MEMORY_ENABLED else "") +
         "• /help: Displays this help message.\n\n"
         "• **Image Analysis**: Send a photo with a text caption to get an analysis of the image."
     )
     await msg.answer(help_text)
 
+@user.message(Command("new"))
+async def new_conversation_handler(msg: Message):
+    """
+    Handler for the /new command: clears the user's conversation history.
+    """
+    if not MEMORY_ENABLED:
+        await msg.answer("I don't remember earlier messages, so every message already starts a new conversation.")
+        return
+    await memory.reset(msg.from_user.id)
+    await msg.answer("Okay, let's start over. I've forgotten our previous conversation.")
+
 @user.message(Command("generate_image"))
 async def generate_image_handler(msg: Message, bot: Bot):
     """
@@ -61,23 +102,28 @@ async def generate_image_handler(msg: Message, bot: Bot):
         await msg.answer("Please provide a prompt after the command. Example: `/generate_image a dog in a spacesuit`")
         return
 
-    await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.UPLOAD_PHOTO)
-    
-    result = await handle_generate_image(prompt, bot)
+    async def work():
+        await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.UPLOAD_PHOTO)
 
-    if isinstance(result, BufferedInputFile):
-        await msg.answer_photo(photo=result)
-    else:
+        started = time.monotonic()
+        result = await handle_generate_image(prompt, bot)
+
+        if isinstance(result, BufferedInputFile):
+            await msg.answer_photo(photo=result)
+            return JobOutcome(IMAGEN_3_MODEL, 1, started)
         await msg.answer(result)
 
+    # A newer /generate_image from the same user replaces one that is still waiting
+    await run_job(msg, "image", work, {"prompt": prompt}, (IMAGEN_3_MODEL, 1), supersede=True)
+
 @user.message(Command("generate_speech"))
 async def generate_speech_handler(msg: Message, bot: Bot):
     """
     Handler for the /generate_speech command.
     """
-    log.info(f"Received command: '{msg.text}'")
+    log.debug(f"Received command: '{msg.text}'")
     command_parts = msg.text.removeprefix("/generate_speech ").strip().split(maxsplit=1)
-    log.info(f"Parsed command parts: {command_parts}")
+    log.debug(f"Parsed command parts: {command_parts}")
     
     # Check if a voice name and text were provided
     if len(command_parts) < 2:
@@ -100,24 +146,56 @@ async def generate_speech_handler(msg: Message, bot: Bot):
         )
         return
 
-    await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.UPLOAD_VOICE)
+    async def work():
+        await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.UPLOAD_VOICE)
 
-    audio_file = await handle_generate_speech(text, voice_name, bot)
-    
-    if audio_file:
-        await msg.answer_voice(voice=audio_file)
-    else:
+        started = time.monotonic()
+        on_first_chunk = (lambda first: msg.answer_voice(voice=first)) if TTS_SEND_FIRST_CHUNK else None
+        audio_file = await handle_generate_speech(text, voice_name, bot, on_first_chunk=on_first_chunk)
+
+        if audio_file:
+            await msg.answer_voice(voice=audio_file)
+            return JobOutcome(TTS_MODEL, len(text), started)
         await msg.answer("Sorry, I couldn't generate the speech. Check the console or `bot.log` for details.")
 
+    await run_job(msg, "tts", work, {"text": text, "voice": voice_name}, (TTS_MODEL, len(text)), supersede=True)
+
 @user.message(lambda msg: msg.text and not msg.photo)
 async def text_handler(msg: Message, bot: Bot):
     """
     Handler for all other text messages.
     """
-    await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.TYPING)
-    
-    response = await gemini(msg.text)
-    await msg.answer(response)
+    async def work():
+        if not MEMORY_ENABLED:
+            return await answer(None)
+        conversation = await memory.get(msg.from_user.id)
+        # One reply at a time per user, so each message sees the turns before it
+        async with conversation.lock:
+            return await answer(conversation)
+
+    async def answer(conversation):
+        await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.TYPING)
+
+        started = time.monotonic()
+        history = conversation.history() if conversation else None
+        if STREAM_RESPONSES:
+            reply = StreamingReply(msg)
+            chunks = []
+            async for chunk in gemini_stream(msg.text, history=history):
+                chunks.append(chunk)
+                await reply.feed(chunk)
+            await reply.finish()
+            response = "".join(chunks)
+        else:
+            response = await gemini(msg.text, history=history)
+            await msg.answer(response)
+        if response in TEXT_ERROR_REPLIES:
+            return None
+        if conversation is not None:
+            await memory.add_turn(conversation, msg.text, response)
+        return JobOutcome(GEMINI_FLASH_MODEL, len(msg.text), started)
+
+    await run_job(msg, "text", work, {"prompt": msg.text}, (GEMINI_FLASH_MODEL, len(msg.text)))
 
 @user.message(lambda msg: msg.photo)
 async def image_handler(msg: Message, bot: Bot):
@@ -125,14 +203,22 @@ async def image_handler(msg: Message, bot: Bot):
     Handler for messages with photos.
     """
     if msg.caption:
-        await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.TYPING)
-        
-        photo = msg.photo[-1] # Get the highest resolution photo
-        analysis = await handle_analyze_image(photo, bot)
+        # The smallest size that is still sharp enough for the model, not the full-resolution original
+        photo = pick_photo_size(msg.photo)
 
-        if analysis:
-            await msg.answer(analysis)
-        else:
+        async def work():
+            await bot.send_chat_action(chat_id=msg.chat.id, action=ChatAction.TYPING)
+
+            started = time.monotonic()
+            analysis = await handle_analyze_image(photo, bot, question=msg.caption)
+
+            if analysis:
+                await msg.answer(analysis)
+                return JobOutcome(GEMINI_FLASH_MODEL, 1, started)
             await msg.answer("Sorry, I couldn't analyze that image.")
+
+        # The photo's ids are enough to download it again when the job is replayed after a restart
+        await run_job(msg, "vision", work, {"photo": photo.model_dump(), "caption": msg.caption},
+                      (GEMINI_FLASH_MODEL, 1))
     else:
         await msg.answer("Please send an image with a text caption so I know what to analyze.")
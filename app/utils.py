@@ -2,10 +2,10 @@ import base64
 import requests
 import io
 import wave
-from PIL import Image
 import mimetypes
 
-from config import AITOKEN
+from app.keys import get_key_pool
+from app.limiter import parse_retry_after
 
 def _pcm_to_wav(pcm_data, sample_rate):
     wav_file = io.BytesIO()
@@ -17,9 +17,21 @@ def _pcm_to_wav(pcm_data, sample_rate):
     wav_file.seek(0)
     return wav_file
 
-def generate_image(prompt: str):
+def _post(url, payload):
+    # Takes a key from the shared pool, so these helpers also spread load and skip throttled keys
+    keys = get_key_pool()
+    key = keys.acquire()
+    try:
+        response = requests.post(url, json=payload, headers=key.headers)
+    except Exception:
+        keys.release(key)
+        raise
+    keys.release(key, response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+    return response
+
+def generate_image(prompt: str, file_path: str = "generated_image.png"):
     # The API endpoint for the image generation model
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/imagen-3.0-generate-002:predict?key={AITOKEN}"
+    url = "https://generativelanguage.googleapis.com/v1beta/models/imagen-3.0-generate-002:predict"
     
     # The payload MUST have "instances" as a list of dictionaries.
     # Each dictionary should contain the "prompt".
@@ -39,7 +51,7 @@ def generate_image(prompt: str):
         if not prompt:
             raise ValueError("Prompt cannot be empty.")
 
-        response = requests.post(url, json=payload)
+        response = _post(url, payload)
         response.raise_for_status() # Raise an exception for bad status codes
         
         result = response.json()
@@ -48,10 +60,10 @@ def generate_image(prompt: str):
         # Decode the base64 data to get the image bytes
         image_bytes = base64.b64decode(base64_data)
         
-        # Open the image from bytes and save it
-        image = Image.open(io.BytesIO(image_bytes))
-        file_path = "generated_image.png"
-        image.save(file_path)
+        # The API already returns a PNG, so write it as is instead of decoding and re-encoding it.
+        # Pass a distinct file_path per call to run several at once (or use app/batch.py for bulk jobs)
+        with open(file_path, "wb") as f:
+            f.write(image_bytes)
         
         return file_path
         
@@ -68,7 +80,7 @@ def generate_image(prompt: str):
 
 
 def analyze_image(image_path, question):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={AITOKEN}"
+    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent"
     with open(image_path, "rb") as image_file:
         encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
     mime_type, _ = mimetypes.guess_type(image_path)
@@ -85,7 +97,7 @@ def analyze_image(image_path, question):
         ]
     }
     try:
-        response = requests.post(url, json=payload)
+        response = _post(url, payload)
         response.raise_for_status()
         result = response.json()
         analysis_text = result['candidates'][0]['content']['parts'][0]['text']
@@ -94,8 +106,8 @@ def analyze_image(image_path, question):
         print(f"Error analyzing image: {e}")
         return None
 
-def generate_speech(text):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={AITOKEN}"
+def generate_speech(text, file_path: str = "generated_speech.wav"):
+    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent"
     payload = {
         "contents": [{ "parts": [{ "text": text }] }],
         "generationConfig": {
@@ -105,7 +117,7 @@ def generate_speech(text):
         "model": "gemini-2.5-flash-preview-tts"
     }
     try:
-        response = requests.post(url, json=payload)
+        response = _post(url, payload)
         response.raise_for_status()
         result = response.json()
         audio_data_b64 = result['candidates'][0]['content']['parts'][0]['inlineData']['data']
@@ -114,7 +126,6 @@ def generate_speech(text):
         if 'rate=' in audio_mime_type: sample_rate = int(audio_mime_type.split('rate=')[1])
         pcm_data = base64.b64decode(audio_data_b64)
         wav_file = _pcm_to_wav(pcm_data, sample_rate)
-        file_path = "generated_speech.wav"
         with open(file_path, "wb") as f:
             f.write(wav_file.read())
         return file_path
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import config
+
+# --- Webhook settings (override any of them in config.py) ---
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+# Public HTTPS address Telegram should call, e.g. "https://bot.example.com"; the path is appended
+WEBHOOK_BASE_URL = getattr(config, "WEBHOOK_BASE_URL", None)
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+
+log = logging.getLogger(__name__)
+
+
+def build_app(bot: Bot, dp: Dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET) -> web.Application:
+    """
+    Creates the aiohttp application that receives updates from Telegram.
+    Requests with a wrong X-Telegram-Bot-Api-Secret-Token are rejected; valid updates are acknowledged
+    immediately and handled in background tasks.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True, secret_token=secret).register(app, path=path)
+    # Runs the dispatcher's startup/shutdown hooks together with the web server
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(bot: Bot, dp: Dispatcher, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                      base_url=WEBHOOK_BASE_URL, secret=WEBHOOK_SECRET, drop_pending_updates=False):
+    """
+    Serves the webhook until cancelled. Registers the webhook with Telegram when base_url is set;
+    leave it unset when a load balancer in front of several processes owns the registration.
+    """
+    app = build_app(bot, dp, path, secret)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    log.info(f"Webhook server listening on http://{host}:{port}{path}")
+
+    if base_url:
+        await bot.set_webhook(
+            url=base_url.rstrip("/") + path,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=drop_pending_updates,
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# --- Local self-test ---
+
+def synthetic_update(update_id: int) -> dict:
+    """
+    An edited_message update without a sender: it passes through the webhook and dispatcher,
+    but no handler replies to it and no user gets registered.
+    """
+    return {
+        "update_id": update_id,
+        "edited_message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "edit_date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "text": "self-test",
+        },
+    }
+
+async def self_test(url: str, secret=WEBHOOK_SECRET, count=100, concurrency=10):
+    """
+    Posts synthetic updates to a running webhook and reports acknowledgement latency.
+    Also checks that a request with a wrong secret token is refused.
+    """
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update_id):
+            nonlocal failures
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(url, json=synthetic_update(update_id), headers=headers) as response:
+                    await response.read()
+                    latencies.append(time.perf_counter() - started)
+                    if response.status != 200:
+                        failures += 1
+
+        await asyncio.gather(*(post(i) for i in range(1, count + 1)))
+
+        rejected = None
+        if secret:
+            async with session.post(url, json=synthetic_update(0), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                rejected = response.status != 200
+
+    latencies.sort()
+    print(f"Sent {count} updates, {failures} failed.")
+    print(f"Ack latency: p50={latencies[len(latencies) // 2] * 1000:.1f}ms, "
+          f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms, max={latencies[-1] * 1000:.1f}ms")
+    if rejected is not None:
+        print("Wrong secret token rejected." if rejected else "WARNING: wrong secret token was accepted!")
+    return failures == 0 and rejected is not False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post synthetic updates to a running webhook.")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    ok = asyncio.run(self_test(args.url, count=args.count, concurrency=args.concurrency))
+    raise SystemExit(0 if ok else 1)
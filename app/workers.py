@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+
+from aiogram import Bot
+from aiogram.types import Update
+
+import config
+from config import TOKEN
+from app.database.models import async_main
+from app.logs import setup_logging, forward_logs, LOG_QUEUE_SIZE
+
+# Number of worker processes in the "workers" run mode
+WORKERS = getattr(config, "WORKERS", os.cpu_count() or 2)
+
+log = logging.getLogger(__name__)
+
+# Update fields whose payload carries a `chat` object
+CHAT_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post", "business_message",
+    "edited_business_message", "my_chat_member", "chat_member", "chat_join_request", "message_reaction",
+)
+
+
+def shard_key(data: dict) -> int:
+    """
+    Returns the chat id an update belongs to (the sender's id when there is no chat).
+    """
+    for field in CHAT_FIELDS:
+        if field in data:
+            return data[field]["chat"]["id"]
+    callback = data.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    for payload in data.values():
+        if isinstance(payload, dict) and "from" in payload:
+            return payload["from"]["id"]
+    return data["update_id"]
+
+
+class ChatSequencer:
+    """
+    Runs updates of different chats concurrently while keeping each chat's updates in arrival order.
+    """
+
+    def __init__(self):
+        self.tails = {}
+        self.tasks = set()
+
+    def submit(self, chat_id, coro):
+        previous = self.tails.get(chat_id)
+        task = asyncio.create_task(self._run_after(previous, coro))
+        self.tails[chat_id] = task
+        self.tasks.add(task)
+        task.add_done_callback(lambda t: self._done(chat_id, t))
+        return task
+
+    async def _run_after(self, previous, coro):
+        if previous is not None:
+            await asyncio.wait([previous])
+        return await coro
+
+    def _done(self, chat_id, task):
+        self.tasks.discard(task)
+        if self.tails.get(chat_id) is task:
+            del self.tails[chat_id]
+
+    async def drain(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+
+# --- Worker process ---
+
+async def _worker_loop(index: int, queue, workers: int):
+    # Imported here because main imports this module
+    from main import create_dispatcher
+    from app import keys, limiter
+
+    # Every worker calls Gemini with the same keys, so each gets its share of the configured limits
+    limiter.set_process_share(workers)
+    keys.set_process_share(workers)
+
+    bot = Bot(token=TOKEN)
+    dp = create_dispatcher(primary=index == 0)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    sequencer = ChatSequencer()
+    loop = asyncio.get_running_loop()
+    log.info(f"Worker {index} started (pid {os.getpid()}).")
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            data = json.loads(raw)
+            update = Update.model_validate(data, context={"bot": bot})
+            sequencer.submit(shard_key(data), dp.feed_update(bot, update))
+        await sequencer.drain()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        log.info(f"Worker {index} stopped.")
+
+def worker_main(index: int, queue, workers: int, log_queue):
+    # The front process writes every worker's records, so bot.log has a single writer
+    setup_logging(log_queue=log_queue)
+    asyncio.run(_worker_loop(index, queue, workers))
+
+
+# --- Front process ---
+
+async def run_workers(bot: Bot, workers=WORKERS, drop_pending_updates=False):
+    """
+    Long-polls Telegram in this process and hands every update to worker `chat_id % workers`,
+    so each chat is handled in order by exactly one worker while different chats use all cores.
+    """
+    from main import create_dispatcher
+
+    # Migrate once here so workers never race on the schema
+    await async_main()
+    allowed_updates = create_dispatcher(primary=False).resolve_used_update_types()
+
+    context = multiprocessing.get_context("spawn")
+    log_queue = context.Queue(LOG_QUEUE_SIZE)
+    forward_logs(log_queue)
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=worker_main, args=(index, queue, workers, log_queue), name=f"bot-worker-{index}")
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    log.info(f"Started {workers} workers.")
+
+    await bot.delete_webhook(drop_pending_updates=drop_pending_updates)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception as e:
+                log.error(f"Failed to fetch updates: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                data = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+                queues[shard_key(data) % workers].put(json.dumps(data))
+                offset = update.update_id + 1
+    finally:
+        for queue in queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        await bot.session.close()
@@ -0,0 +1,106 @@
+import asyncio
+import functools
+import itertools
+import os
+import time
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    """
+    Minimal Bot API server: answers sendMessage, sendPhoto, sendVoice, editMessageText and friends
+    with plausible results, and serves file downloads for photos sent to the bot.
+    """
+
+    def __init__(self, latency=0.0, file_size=150_000):
+        self.latency = latency
+        self.file_size = file_size
+        self.message_ids = itertools.count(1_000_000)
+        self.runner = None
+        self.reset_stats()
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise ValueError(f"Unknown fake Telegram setting: {name}")
+            setattr(self, name, value)
+
+    def reset_stats(self):
+        self.stats = {"methods": {}, "bytes_received": 0, "downloads": 0}
+
+    async def start(self, host="127.0.0.1", port=0) -> str:
+        """
+        Starts the server and returns its base URL (for TelegramAPIServer.from_base).
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        app.router.add_post("/_bench/configure", self.handle_configure)
+        app.router.add_get("/_bench/stats", self.handle_stats)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_configure(self, request: web.Request):
+        self.configure(**await request.json())
+        self.reset_stats()
+        return web.json_response({"ok": True})
+
+    async def handle_stats(self, request: web.Request):
+        return web.json_response(self.stats)
+
+    # --- Bot API ---
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.stats["methods"][method] = self.stats["methods"].get(method, 0) + 1
+        fields = await request.post()
+        # Uploads arrive as chunked multipart, so count the parts instead of Content-Length
+        self.stats["bytes_received"] += sum(_size(value) for value in fields.values())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self._result(method.lower(), fields)})
+
+    def _result(self, method, fields):
+        chat_id = int(fields.get("chat_id", 0) or 0)
+        if method in ("sendmessage", "sendphoto", "sendvoice", "senddocument", "editmessagetext", "copymessage"):
+            if method == "copymessage":
+                return {"message_id": next(self.message_ids)}
+            message = {
+                "message_id": int(fields.get("message_id", 0) or 0) or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+            if "text" in fields:
+                message["text"] = fields["text"]
+            return message
+        if method == "getfile":
+            file_id = fields.get("file_id", "file")
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": self.file_size,
+                    "file_path": f"photos/{file_id}.jpg"}
+        if method == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        return True
+
+    async def handle_file(self, request: web.Request):
+        self.stats["downloads"] += 1
+        return web.Response(body=_file_body(self.file_size), content_type="image/jpeg")
+
+
+def _size(value) -> int:
+    if isinstance(value, web.FileField):
+        return value.file.seek(0, os.SEEK_END)
+    return len(str(value))
+
+@functools.lru_cache(maxsize=4)
+def _file_body(size):
+    return os.urandom(size)
@@ -0,0 +1,149 @@
+import asyncio
+import base64
+import functools
+import io
+import json
+import os
+import random
+
+from aiohttp import web
+
+
+class MockGemini:
+    """
+    Local stand-in for the generateContent, streamGenerateContent, predict and TTS endpoints
+    used by app/generators.py, with configurable latency, 429 rate and payload sizes.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, rate_429=0.0, retry_after=None, text_size=400,
+                 image_size=200_000, audio_seconds=2.0, stream_chunks=8, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.text_size = text_size
+        self.image_size = image_size
+        self.audio_seconds = audio_seconds
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.runner = None
+        self.reset_stats()
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise ValueError(f"Unknown mock setting: {name}")
+            setattr(self, name, value)
+
+    def reset_stats(self):
+        self.stats = {"requests": {}, "keys": {}, "throttled": 0, "bytes_sent": 0}
+
+    async def start(self, host="127.0.0.1", port=0) -> str:
+        """
+        Starts the server and returns its base URL (use it as GEMINI_BASE_URL).
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1beta/models/{target}", self.handle)
+        app.router.add_post("/_bench/configure", self.handle_configure)
+        app.router.add_get("/_bench/stats", self.handle_stats)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    # --- Control routes, used by the driver when the mock runs in another process ---
+
+    async def handle_configure(self, request: web.Request):
+        self.configure(**await request.json())
+        self.reset_stats()
+        return web.json_response({"ok": True})
+
+    async def handle_stats(self, request: web.Request):
+        return web.json_response(self.stats)
+
+    # --- Request handling ---
+
+    async def _delay(self, scale=1.0):
+        delay = max(0.0, self.random.gauss(self.latency, self.jitter)) * scale
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def handle(self, request: web.Request):
+        model, _, action = request.match_info["target"].partition(":")
+        kind = "tts" if "tts" in model else action
+        self.stats["requests"][kind] = self.stats["requests"].get(kind, 0) + 1
+        await request.read()
+
+        key = request.headers.get("x-goog-api-key")
+        if not key or "key" in request.query:
+            # The bot must send its key in the header, never in the URL
+            return web.json_response({"error": {"code": 401, "message": "API key missing"}}, status=401)
+        self.stats["keys"][key] = self.stats["keys"].get(key, 0) + 1
+
+        if self.rate_429 and self.random.random() < self.rate_429:
+            self.stats["throttled"] += 1
+            headers = {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+            return web.json_response({"error": {"code": 429, "message": "Resource exhausted"}}, status=429, headers=headers)
+
+        if action == "streamGenerateContent":
+            return await self._stream(request)
+        await self._delay()
+        if action == "predict":
+            body = {"predictions": [{"bytesBase64Encoded": self._png_b64(self.image_size), "mimeType": "image/png"}]}
+        elif kind == "tts":
+            pcm_size = int(self.audio_seconds * 24000) * 2
+            body = {"candidates": [{"content": {"parts": [{"inlineData": {
+                "mimeType": "audio/L16;codec=pcm;rate=24000", "data": self._b64(pcm_size)}}]}}]}
+        else:
+            body = {"candidates": [{"content": {"parts": [{"text": self._text(self.text_size)}]}}]}
+        data = json.dumps(body).encode()
+        self.stats["bytes_sent"] += len(data)
+        return web.Response(body=data, content_type="application/json")
+
+    async def _stream(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunk_size = max(1, self.text_size // self.stream_chunks)
+        for _ in range(self.stream_chunks):
+            await self._delay(1 / self.stream_chunks)
+            event = {"candidates": [{"content": {"parts": [{"text": self._text(chunk_size)}]}}]}
+            data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+            self.stats["bytes_sent"] += len(data)
+            await response.write(data)
+        await response.write_eof()
+        return response
+
+    def _text(self, size):
+        words = []
+        length = 0
+        while length < size:
+            word = self.random.choice(("lorem", "ipsum", "dolor", "sit", "amet", "gemini", "bench", "token"))
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)[:size]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def _b64(size):
+        # Generated once per size so the mock's own CPU time stays out of the measurements
+        return base64.b64encode(os.urandom(size)).decode()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def _png_b64(size):
+        # A real noise PNG of about `size` bytes so the bot's image re-encoding does real work
+        try:
+            from PIL import Image
+        except ImportError:
+            return MockGemini._b64(size)
+        side = max(int((size / 3) ** 0.5), 1)
+        output = io.BytesIO()
+        Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(output, "PNG")
+        return base64.b64encode(output.getvalue()).decode()
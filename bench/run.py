@@ -0,0 +1,355 @@
+"""
+Load test for the bot: feeds synthetic updates through the real Dispatcher and routers while
+Gemini and the Bot API are replaced by local stand-ins running in a separate process.
+
+    python -m bench.run                            # every scenario
+    python -m bench.run text mixed --scale 2       # some scenarios, twice the updates
+    python -m bench.run --compare old.json new.json
+
+Results are written to bench/results/<time>-<commit>.json. Rate limits, pool sizes and the other
+settings from config.py apply as usual; only the endpoints, database and cache directory are redirected.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import aiohttp
+
+REPO = Path(__file__).resolve().parent.parent
+# main.py and app/ are imported after the working directory changes
+sys.path.insert(0, str(REPO))
+RESULTS_DIR = REPO / "bench" / "results"
+
+# mix: relative share of each request kind; updates: default count (scaled by --scale)
+SCENARIOS = {
+    "text": {"mix": {"text": 1}, "updates": 300, "stream": False},
+    "text_stream": {"mix": {"text": 1}, "updates": 300, "stream": True},
+    "cached": {"mix": {"text": 1}, "updates": 300, "repeat": 0.9},
+    "vision": {"mix": {"vision": 1}, "updates": 100},
+    "tts": {"mix": {"tts": 1}, "updates": 60},
+    "image": {"mix": {"image": 1}, "updates": 30},
+    "mixed": {"mix": {"text": 6, "vision": 2, "tts": 1, "image": 1}, "updates": 200},
+    "throttled": {"mix": {"text": 1}, "updates": 150, "mock": {"rate_429": 0.2}},
+}
+
+MOCK_DEFAULTS = {"latency": 0.05, "jitter": 0.02, "rate_429": 0.0, "retry_after": None, "text_size": 400,
+                 "image_size": 200_000, "audio_seconds": 2.0, "stream_chunks": 8}
+
+
+# --- Stand-in servers (child process) ---
+
+def _serve(conn):
+    from bench.fake_telegram import FakeTelegram
+    from bench.mock_gemini import MockGemini
+
+    async def serve():
+        gemini, telegram = MockGemini(seed=1), FakeTelegram()
+        conn.send((await gemini.start(), await telegram.start()))
+        # Any message from the parent means stop
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        await gemini.stop()
+        await telegram.stop()
+
+    asyncio.run(serve())
+
+
+class StandIns:
+    """
+    Runs the mock Gemini and fake Bot API servers in their own process, so their CPU time
+    does not compete with the bot's event loop.
+    """
+
+    def __init__(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn,), name="bench-stand-ins", daemon=True)
+        self.process.start()
+        self.gemini_url, self.telegram_url = self.conn.recv()
+        self.session = None
+
+    async def configure(self, gemini: dict, telegram: dict):
+        self.session = self.session or aiohttp.ClientSession()
+        for url, settings in ((self.gemini_url, gemini), (self.telegram_url, telegram)):
+            async with self.session.post(f"{url}/_bench/configure", json=settings) as response:
+                response.raise_for_status()
+
+    async def stats(self) -> dict:
+        result = {}
+        for name, url in (("gemini", self.gemini_url), ("telegram", self.telegram_url)):
+            async with self.session.get(f"{url}/_bench/stats") as response:
+                result[name] = await response.json()
+        return result
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.conn.send("stop")
+        self.process.join(10)
+
+
+def _prepare_config(gemini_url: str, workdir: str, keys=1):
+    # Must run before anything from app/ is imported: settings are read at import time
+    try:
+        import config
+    except ImportError:
+        # An empty file rather than a bare module, so spawned image workers can import it too
+        open(os.path.join(workdir, "config.py"), "w").close()
+        sys.path.insert(0, workdir)
+        import config
+    config.TOKEN = "123456:BENCH"
+    config.AITOKENS = [f"bench-key-{index}" for index in range(keys)]
+    config.GEMINI_BASE_URL = gemini_url
+    config.GEMINI_WARMUP_CONNECTIONS = 0
+    config.DATABASE_URL = f"sqlite+aiosqlite:///{workdir}/bench.sqlite3"
+    config.CACHE_DIR = f"{workdir}/cache"
+    config.METRICS_PORT = None
+
+
+# --- Driver ---
+
+class Driver:
+    """
+    Builds synthetic updates and feeds them to the dispatcher with bounded concurrency.
+    """
+
+    def __init__(self, bot, dp, users: int, seed=1):
+        self.bot = bot
+        self.dp = dp
+        self.users = users
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def make_update(self, kind: str, user_id: int, prompt: str):
+        from aiogram.types import Update
+
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        }
+        if kind == "text":
+            message["text"] = prompt
+        elif kind == "image":
+            message["text"] = f"/generate_image {prompt}"
+        elif kind == "tts":
+            message["text"] = f"/generate_speech Kore {prompt}"
+        elif kind == "vision":
+            file_id = f"photo-{message['message_id']}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}]
+            message["caption"] = prompt
+        return Update.model_validate({"update_id": next(self.update_ids), "message": message}, context={"bot": self.bot})
+
+    def plan(self, name: str, spec: dict, count: int):
+        kinds, weights = zip(*spec["mix"].items())
+        repeat = spec.get("repeat", 0.0)
+        for index in range(count):
+            kind = self.random.choices(kinds, weights)[0]
+            number = self.random.randrange(10) if self.random.random() < repeat else index
+            prompt = f"{name} request {number}: describe a lighthouse at dawn"
+            # Consecutive updates come from different users, so superseding rarely kicks in
+            yield self.make_update(kind, 10_000 + index % self.users, prompt)
+
+    async def run(self, name: str, spec: dict, count: int, concurrency: int) -> dict:
+        updates = list(self.plan(name, spec, count))
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def feed(update):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                except Exception as e:
+                    errors += 1
+                    logging.getLogger("bench").error(f"Update {update.update_id} failed: {e}")
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(feed(update) for update in updates))
+        duration = time.perf_counter() - started
+        return {"updates": count, "concurrency": concurrency, "duration_s": round(duration, 3),
+                "throughput_per_s": round(count / duration, 2), "errors": errors,
+                "latency_ms": _summarize(latencies)}
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def _summarize(latencies) -> dict:
+    ordered = sorted(latencies)
+    if not ordered:
+        return {}
+    return {
+        "p50": round(_percentile(ordered, 0.50) * 1000, 2),
+        "p95": round(_percentile(ordered, 0.95) * 1000, 2),
+        "p99": round(_percentile(ordered, 0.99) * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return _peak_rss_mb()
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+def _git(*args) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=REPO, capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        return ""
+
+
+async def benchmark(names, scale=1.0, concurrency=50, users=200, latency=None, trace_memory=False, warmup=20, keys=1):
+    """
+    Runs the given scenarios and returns the results as a dict ready for JSON.
+    """
+    stand_ins = StandIns()
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    _prepare_config(stand_ins.gemini_url, workdir, keys)
+    # The app logs to bot.log in the working directory; keep it out of the repo
+    os.chdir(workdir)
+
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import app.user
+    from app.scheduler import get_scheduler
+    from main import create_dispatcher
+
+    # Per-request log lines would dominate the profile; errors still show up
+    logging.getLogger().setLevel(logging.ERROR)
+    bot = Bot(token="123456:BENCH", session=AiohttpSession(api=TelegramAPIServer.from_base(stand_ins.telegram_url)))
+    dp = create_dispatcher(primary=True)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    driver = Driver(bot, dp, users)
+
+    results = {
+        "commit": _git("rev-parse", "--short", "HEAD") or None,
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"scale": scale, "concurrency": concurrency, "users": users, "latency": latency, "keys": keys},
+        "scenarios": {},
+    }
+    try:
+        if warmup:
+            await stand_ins.configure(MOCK_DEFAULTS, {})
+            await driver.run("warmup", SCENARIOS["text"], warmup, concurrency)
+
+        for name in names:
+            spec = SCENARIOS[name]
+            mock = {**MOCK_DEFAULTS, **spec.get("mock", {})}
+            if latency is not None:
+                mock["latency"] = latency
+            await stand_ins.configure(mock, {})
+            app.user.STREAM_RESPONSES = spec.get("stream", True)
+            cancelled_before = get_scheduler().cancelled
+
+            if trace_memory:
+                tracemalloc.start()
+            rss_before = _rss_mb()
+            result = await driver.run(name, spec, max(1, int(spec["updates"] * scale)), concurrency)
+            result["memory_mb"] = {"rss_before": round(rss_before, 1), "rss_after": round(_rss_mb(), 1),
+                                   "peak_rss": round(_peak_rss_mb(), 1)}
+            if trace_memory:
+                result["memory_mb"]["python_peak"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                tracemalloc.stop()
+
+            result["superseded"] = get_scheduler().cancelled - cancelled_before
+            result["mock"] = mock
+            result.update(await stand_ins.stats())
+            results["scenarios"][name] = result
+            _print_result(name, result)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        await stand_ins.close()
+    return results
+
+
+# --- Reporting ---
+
+def _print_result(name, result):
+    latency = result["latency_ms"]
+    print(f"{name:<12} {result['updates']:>5} updates  {result['throughput_per_s']:>8.1f}/s  "
+          f"p50={latency['p50']:.0f}ms p95={latency['p95']:.0f}ms p99={latency['p99']:.0f}ms  "
+          f"rss={result['memory_mb']['rss_after']:.0f}MB  errors={result['errors']}", flush=True)
+
+def compare(old: dict, new: dict):
+    """
+    Prints throughput and latency changes between two result files.
+    """
+    print(f"{'scenario':<12} {'throughput/s':>24} {'p95 ms':>24} {'p99 ms':>24}")
+    for name, after in new["scenarios"].items():
+        before = old["scenarios"].get(name)
+        if before is None:
+            continue
+        cells = []
+        for old_value, new_value in ((before["throughput_per_s"], after["throughput_per_s"]),
+                                     (before["latency_ms"]["p95"], after["latency_ms"]["p95"]),
+                                     (before["latency_ms"]["p99"], after["latency_ms"]["p99"])):
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            cells.append(f"{old_value:.1f} -> {new_value:.1f} ({change:+.0f}%)")
+        print(f"{name:<12} " + " ".join(f"{cell:>24}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local stand-ins for Gemini and Telegram.")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run (default: all): {', '.join(SCENARIOS)}.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for the number of updates per scenario.")
+    parser.add_argument("--concurrency", type=int, default=50, help="Updates handled at the same time.")
+    parser.add_argument("--users", type=int, default=200, help="Distinct synthetic users.")
+    parser.add_argument("--latency", type=float, help="Mock Gemini latency in seconds for every scenario.")
+    parser.add_argument("--keys", type=int, default=1, help="Number of Gemini API keys in the pool.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also record the Python heap peak (slower).")
+    parser.add_argument("--out", help="Where to write the JSON results.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit.")
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = (json.loads(Path(path).read_text()) for path in args.compare)
+        compare(old, new)
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    # Resolved now because the benchmark changes the working directory
+    out = Path(args.out).resolve() if args.out else None
+
+    results = asyncio.run(benchmark(names, args.scale, args.concurrency, args.users, args.latency, args.tracemalloc,
+                                    keys=args.keys))
+    out = out or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit'] or 'nogit'}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2))
+    print(f"Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
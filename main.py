@@ -1,11 +1,84 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, F
+import config
 from config import TOKEN
 from app.user import user as user_router
+from app.admin import admin as admin_router
+from app.client import start_client, close_client
+from app.broadcast import resume_broadcasts
+from app.jobs import replay_jobs, drain_jobs
+from app.database.models import async_main
+from app.database.ledger import ledger
+from app.middlewares import KnownUserMiddleware, MetricsMiddleware, HandlerMetricsMiddleware, TelegramMetricsMiddleware
+from app.metrics import start_metrics_server, stop_metrics_server
+from app.logs import setup_logging
+from app.imaging import close_pool
+from app.memory import memory
+from app.webhook import run_webhook
+from app.storage import SQLiteStorage
+from app.workers import run_workers
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# "polling", "webhook" or "workers"
+RUN_MODE = getattr(config, "RUN_MODE", "polling")
+# "memory" or "sqlite"; the workers mode always uses "sqlite"
+FSM_STORAGE = getattr(config, "FSM_STORAGE", "memory")
+# Updates that arrived while the bot was offline are handled by default; accepted jobs are deduplicated
+DROP_PENDING_UPDATES = getattr(config, "DROP_PENDING_UPDATES", False)
+
+# Log to bot.log and the console from a background thread, with secrets and big payloads cut out
+setup_logging()
+
+def create_dispatcher(primary: bool = True) -> Dispatcher:
+    """
+    Builds the dispatcher with all routers, middlewares and lifecycle hooks.
+    Only the primary process migrates the database and resumes newsletters.
+    """
+    storage = SQLiteStorage() if FSM_STORAGE == "sqlite" or RUN_MODE == "workers" else None
+    dp = Dispatcher(storage=storage)
+
+    # Trace and time every update, then make sure every sender is registered; known users are served from memory
+    dp.update.outer_middleware(MetricsMiddleware())
+    dp.update.outer_middleware(KnownUserMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+
+    # Register the admin and user routers with all their handlers
+    dp.include_router(admin_router)
+    dp.include_router(user_router)
+
+    # Shutdown hooks run in registration order: let running jobs finish while the pool and ledger are still up
+    dp.shutdown.register(drain_jobs)
+
+    # Open the shared Gemini connection pool on startup and close it on shutdown
+    dp.startup.register(start_client)
+
+    if primary:
+        # Create the database tables and pick up newsletters and jobs interrupted by a restart
+        dp.startup.register(async_main)
+        dp.startup.register(resume_broadcasts)
+
+    # Batch usage billing in the background; the last batch is written on shutdown
+    dp.startup.register(ledger.start)
+    dp.shutdown.register(ledger.stop)
+    dp.shutdown.register(close_client)
+    dp.shutdown.register(close_pool)
+    # Evict idle conversations in the background
+    dp.startup.register(memory.start)
+    dp.shutdown.register(memory.stop)
+
+    if primary:
+        dp.startup.register(replay_jobs)
+        # Serve /metrics locally; in the workers mode only the first worker exposes its numbers
+        dp.startup.register(start_metrics_server)
+        dp.shutdown.register(stop_metrics_server)
+    dp.startup.register(instrument_bot)
+    return dp
+
+async def instrument_bot(bot: Bot):
+    """
+    Times every Bot API call made through this bot's session.
+    """
+    bot.session.middleware(TelegramMetricsMiddleware())
 
 async def main():
     """
@@ -13,13 +86,21 @@ async def main():
     """
     logging.info("Starting bot...")
     bot = Bot(token=TOKEN)
-    dp = Dispatcher()
 
-    # Register the user router with all its handlers
-    dp.include_router(user_router)
+    if RUN_MODE == "workers":
+        # One process receives updates and shards them by chat across worker processes
+        await run_workers(bot, drop_pending_updates=DROP_PENDING_UPDATES)
+        return
+
+    dp = create_dispatcher()
+
+    if RUN_MODE == "webhook":
+        # Serve updates over HTTP so several processes can sit behind a load balancer
+        await run_webhook(bot, dp, drop_pending_updates=DROP_PENDING_UPDATES)
+        return
 
-    # Start the bot and skip any updates that occurred while the bot was offline
-    await bot.delete_webhook(drop_pending_updates=True)
+    # Start the bot; updates sent while it was offline are handled unless DROP_PENDING_UPDATES is set
+    await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
     await dp.start_polling(bot)
 
 if __name__ == "__main__":